@@ -0,0 +1,42 @@
+import typing
+import numpy as np
+
+
+class Skew(typing.NamedTuple):
+    offset: float
+    drift: float
+
+
+def estimate_skew(reference: np.ndarray, other: np.ndarray) -> Skew:
+    """
+    Fit the timestamps of other against those of reference, frame by frame.
+    Returns the offset in seconds of other at the start of the run, and its
+    drift in seconds per second.
+    """
+    reference, other = np.asarray(reference, np.float64), np.asarray(other, np.float64)
+    n = min(len(reference), len(other))
+    if n < 2:
+        return Skew(float(other[0] - reference[0]) if n else 0., 0.)
+
+    elapsed = reference[:n] - reference[0]
+    drift, offset = np.polyfit(elapsed, other[:n] - reference[:n], 1)
+    return Skew(float(offset), float(drift))
+
+
+def align(readings: typing.List[np.ndarray], timestamps: typing.List[np.ndarray], rate: float) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Resample the readings of every device onto a common time base at rate Hz,
+    covering the interval all devices have samples for.
+    Returns the time base along with the readings of all devices side by side.
+    """
+    start = max(t[0] for t in timestamps)
+    end = min(t[-1] for t in timestamps)
+    base = np.arange(start, end, 1. / rate)
+
+    columns = []
+    for values, t in zip(readings, timestamps):
+        values = np.asarray(values, np.float64)
+        for sensor in range(values.shape[1]):
+            columns.append(np.interp(base, t, values[:, sensor]))
+
+    return base, np.rint(np.stack(columns, axis=1)).astype(np.uint8)
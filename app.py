@@ -3,6 +3,8 @@ from flask import Flask, render_template
 from frontend import frontend
 from collector import collector
 from filters import filters
+from spool import Spool, Replayer
+from ingest import IngestWorker, DeadLetters
 from config import ProductionConfig, DevelopmentConfig
 
 app = Flask(__name__, static_url_path='/static')
@@ -14,6 +16,21 @@ if app.config.get('FLASK_ENV', '') == 'development':
 else:
     app.config.from_object(ProductionConfig)
 
+# Repetitions that cannot be written to the database at all end up here
+app.extensions['dead_letters'] = DeadLetters(app.config.get('DEAD_LETTER_FILE', 'dead_letters.jsonl'))
+
+# Spool collected repetitions locally before they are written to the database
+if app.config.get('SPOOL_FOLDER'):
+    app.extensions['spool'] = Spool(app.config.get('SPOOL_FOLDER'))
+    Replayer(app.extensions['spool'], app, dead_letters=app.extensions['dead_letters']).start()
+
+# Write collected repetitions to the database in the background, batched per commit interval
+if app.config.get('INGEST_QUEUE_SIZE'):
+    app.extensions['ingest'] = IngestWorker(app, app.config.get('INGEST_QUEUE_SIZE'),
+                                            app.config.get('INGEST_COMMIT_INTERVAL', .5),
+                                            dead_letters=app.extensions['dead_letters'])
+    app.extensions['ingest'].start()
+
 app.register_blueprint(frontend)
 app.register_blueprint(collector, url_prefix='/collect')
 app.register_blueprint(filters)
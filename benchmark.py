@@ -0,0 +1,65 @@
+import argparse
+import time
+from simulator import VirtualBIOX
+from discovery import Device
+from sessions import pool
+from calibrator import calibrate
+from collector import collect
+
+
+def benchmark(rate=1000., duration=5., latency=0., drop_rate=0., seed=None) -> dict:
+    """
+    Collect from, calibrate and stream from simulated arm and wrist devices,
+    so the data path can be measured without the armbands attached.
+    Sample requests are only dropped while streaming, collect waits for every answer.
+    """
+    simulators = [VirtualBIOX('VIRTUAL_ARM', sensors=8, latency=latency, seed=seed),
+                  VirtualBIOX('VIRTUAL_WRIST', sensors=7, latency=latency, seed=seed)]
+    results = {}
+
+    try:
+        devices = []
+        for name, simulator in zip(['arm', 'wrist'], simulators):
+            simulator.start()
+            devices.append(Device(name, simulator.serial_number, simulator.sensors, simulator.port_info()))
+
+        data, stats, skews = collect(devices, rate, duration)
+        results['collect'] = {**stats._asdict(), 'frames': len(data), 'skews': skews}
+
+        for device in devices:
+            with pool.lease(device.serial_number, device.port.device, sensors=device.sensors) as biox:
+                start = time.perf_counter()
+                result = calibrate(biox)
+                results[f'calibrate_{device.name}'] = {
+                    'iterations': result.iterations, 'reads': result.reads,
+                    'seconds': time.perf_counter() - start}
+
+        for device, simulator in zip(devices, simulators):
+            simulator.drop_rate = drop_rate
+            with pool.lease(device.serial_number, device.port.device, sensors=device.sensors) as biox:
+                stream = biox.start_stream()
+                time.sleep(duration)
+                frames, dropped, error = stream.count, biox.dropped_requests, biox.stream_error
+                biox.stop_stream()
+            results[f'stream_{device.name}'] = {
+                'frames': frames, 'rate': frames / duration, 'dropped_requests': dropped,
+                'error': repr(error) if error else None}
+    finally:
+        pool.close()
+        for simulator in simulators:
+            simulator.stop()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the data path against simulated BIOX devices.')
+    parser.add_argument('--rate', type=float, default=1000.)
+    parser.add_argument('--duration', type=float, default=5.)
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--drop-rate', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    for name, result in benchmark(args.rate, args.duration, args.latency, args.drop_rate, args.seed).items():
+        print(f'{name}: {result}')
@@ -1,12 +1,34 @@
 from serial import Serial
-from time import sleep
+from serial.serialutil import SerialException
+from time import sleep, perf_counter
+import threading
 import typing
+import numpy as np
+
+FRAME_SIZE = 8
+
+
+def decode_frames(buffer: bytes, sensors: int = FRAME_SIZE) -> typing.Tuple[np.ndarray, bytes]:
+    """
+    Decode every complete frame in buffer without copying it.
+    Returns a read-only uint8 view of shape (n_frames, sensors) along with
+    the bytes of a trailing partial frame, if any.
+    """
+    n_frames = len(buffer) // FRAME_SIZE
+    frames = np.frombuffer(buffer, dtype=np.uint8, count=n_frames * FRAME_SIZE)
+    return frames.reshape(n_frames, FRAME_SIZE)[:, :sensors], buffer[n_frames * FRAME_SIZE:]
 
 
 class BIOX(Serial):
     def __init__(self, port, baudrate=256000, timeout= None, sensors=8):
         super().__init__(port=port, baudrate=baudrate, timeout=timeout)
         self.sensors = sensors
+        self.stream: RingBuffer = None
+        self.stream_error: Exception = None
+        self.dropped_requests = 0
+        self._partial = b''
+        self._streaming = threading.Event()
+        self._reader: threading.Thread = None
         self.connect()
         self.calibration = Calibration(self)
         self.flush()
@@ -44,9 +66,19 @@ class BIOX(Serial):
         """
         Read all lines currently available in the buffer of the OS.
         """
-        buffer = list(super().read_all())
-        lines = [buffer[i:i+8] for i in range(0, len(buffer), 8)]
-        return lines[:][:self.sensors]
+        return self.read_frames().tolist()
+
+    def read_frames(self) -> np.ndarray:
+        """
+        Read all complete frames currently available in the buffer of the OS
+        as a (n_frames, sensors) uint8 array. A trailing partial frame is kept
+        and completed by the next call.
+        """
+        buffer = super().read_all()
+        if self._partial:
+            buffer = self._partial + buffer
+        frames, self._partial = decode_frames(buffer, self.sensors)
+        return frames
 
     def connect(self) -> None:
         """
@@ -67,40 +99,126 @@ class BIOX(Serial):
         """
         Flush the input and output buffer.
         """
+        self._partial = b''
         super().flush()
         super().reset_input_buffer()
         super().reset_output_buffer()
 
+    def start_stream(self, capacity=60000, depth=16, stall_timeout=.05) -> 'RingBuffer':
+        """
+        Start a reader thread that keeps up to depth sample requests in flight,
+        reads the answers in bulk and decodes them into a ring buffer holding
+        the latest capacity frames. Requests still unanswered after stall_timeout
+        seconds without any bytes arriving are counted in dropped_requests and resent.
+        """
+        if self._streaming.is_set():
+            return self.stream
+
+        self.flush()
+        self.stream = RingBuffer(capacity, self.sensors)
+        self.stream_error = None
+        self.dropped_requests = 0
+        self._streaming.set()
+        self._reader = threading.Thread(
+            target=self._read_stream, args=(depth, stall_timeout), daemon=True)
+        self._reader.start()
+        return self.stream
+
+    def stop_stream(self) -> None:
+        """
+        Stop the reader thread and discard any frames still in flight.
+        """
+        if not self._streaming.is_set():
+            return
+
+        self._streaming.clear()
+        self._reader.join()
+        self._reader = None
+        if self.is_open:
+            self.flush()
+
+    def _read_stream(self, depth, stall_timeout) -> None:
+        """
+        Body of the reader thread started by start_stream.
+        """
+        timeout = self.timeout
+        self.timeout = .01
+        pending = b''
+        in_flight = 0
+        last_received = perf_counter()
+
+        try:
+            while self._streaming.is_set():
+                if in_flight < depth:
+                    super().write(b'S' * (depth - in_flight))
+                    in_flight = depth
+
+                chunk = super().read(self.in_waiting or FRAME_SIZE)
+                received = perf_counter()
+
+                if chunk:
+                    last_received = received
+                elif in_flight and received - last_received > stall_timeout:
+                    # The device dropped the requests still in flight, ask again
+                    self.dropped_requests += in_flight
+                    in_flight = 0
+                    last_received = received
+
+                frames, pending = decode_frames(
+                    pending + chunk if pending else chunk, self.sensors)
+                if len(frames):
+                    self.stream.extend(frames, received)
+                    in_flight = max(in_flight - len(frames), 0)
+        except SerialException as err:
+            self.stream_error = err
+            self._streaming.clear()
+        finally:
+            self.timeout = timeout
+
     def close(self) -> None:
         """
         Close the port.
         """
+        self.stop_stream()
         if self.is_open:
             self.disconnect()
             return super().close()
 
 
 class Calibration():
+    # Seconds the sensors take to settle after each step
+    SETTLE = .01
+
     def __init__(self, biox):
         self.biox: Serial = biox
         self.iterations = 0
         super().__init__()
 
-    def increment(self) -> None:
+    def increment(self, steps=1) -> None:
         """
-        Increment the sensors resting values.
+        Increment the sensors resting values, waiting for every step to settle.
         """
-        self.biox.write('I'.encode())
-        self.iterations += 1
-        sleep(.01)
+        self.biox.write('I'.encode() * steps)
+        self.iterations += steps
+        sleep(self.SETTLE * steps)
 
-    def decrement(self) -> None:
+    def decrement(self, steps=1) -> None:
         """
-        Decrement the sensors resting values.
+        Decrement the sensors resting values, waiting for every step to settle.
         """
-        self.biox.write('i'.encode())
-        self.iterations -= 1
-        sleep(.01)
+        self.biox.write('i'.encode() * steps)
+        self.iterations -= steps
+        sleep(self.SETTLE * steps)
+
+    def goto(self, iterations) -> None:
+        """
+        Increment or decrement the sensors resting values until 
+        they are iterations steps above their reset values.
+        """
+        if iterations > self.iterations:
+            self.increment(iterations - self.iterations)
+        elif iterations < self.iterations:
+            self.decrement(self.iterations - iterations)
 
     def reset(self) -> None:
         """
@@ -110,3 +228,78 @@ class Calibration():
         self.iterations = 0
         self.biox.flush()
         sleep(.1)
+
+
+class RingBuffer():
+    """
+    Fixed size buffer of the latest frames and their receive timestamps.
+    A single writer appends frames, any number of readers may take copies
+    without blocking it.
+    """
+
+    def __init__(self, capacity, sensors):
+        self.capacity = capacity
+        self.frames = np.zeros((capacity, sensors), dtype=np.uint8)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def extend(self, frames: np.ndarray, timestamp: float) -> None:
+        """
+        Append frames received at timestamp, overwriting the oldest ones.
+        """
+        frames = frames[-self.capacity:]
+        start = self.count % self.capacity
+        end = start + len(frames)
+
+        if end <= self.capacity:
+            self.frames[start:end] = frames
+            self.timestamps[start:end] = timestamp
+        else:
+            split = self.capacity - start
+            self.frames[start:] = frames[:split]
+            self.frames[:end - self.capacity] = frames[split:]
+            self.timestamps[start:] = timestamp
+            self.timestamps[:end - self.capacity] = timestamp
+
+        # Publish only once the frames are in place
+        self.count += len(frames)
+
+    def window(self, n: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Copy the latest n frames and their timestamps, oldest first.
+        """
+        count = self.count
+        return self._copy(count - min(n, count, self.capacity), count)
+
+    def snapshot(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Copy every frame currently held in the buffer, oldest first.
+        """
+        return self.window(self.capacity)
+
+    def since(self, count: int) -> typing.Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Copy the frames written after count, along with the new count
+        to pass on the next call. Frames already overwritten are skipped.
+        """
+        current = self.count
+        frames, timestamps = self._copy(
+            max(count, current - self.capacity), current)
+        return frames, timestamps, current
+
+    def _copy(self, start: int, end: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Copy frames start through end, counted since the buffer was created.
+        """
+        idx = np.arange(start, end) % self.capacity
+        frames, timestamps = self.frames[idx], self.timestamps[idx]
+
+        # The writer may have lapped the copied region meanwhile,
+        # in that case fall back to the oldest frames still intact
+        lapped = self.count - self.capacity - start
+        if lapped > 0:
+            return self._copy(start + lapped, max(end, start + lapped))
+        return frames, timestamps
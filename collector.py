@@ -1,14 +1,21 @@
-from flask import Blueprint, render_template, flash, escape, redirect, url_for, request, send_from_directory, json, current_app, make_response
+from flask import Blueprint, render_template, flash, escape, redirect, url_for, request, send_from_directory, json, current_app, make_response, Response
 import os
 from serial import Serial
-from serial.tools import list_ports
-from serial.tools.list_ports_common import ListPortInfo
 import time
 from biox import BIOX
+from scheduler import Scheduler
+from calibrator import calibrate
+from sessions import pool
+from discovery import get_index, Device
+from jobs import jobs, Job
+import database as db
+from ingest import store_repetition
+from alignment import estimate_skew, align
 import numpy as np
 from serial.serialutil import SerialException
 from typing import List
 from concurrent.futures import Future, wait
+from contextlib import ExitStack
 from concurrent.futures.thread import ThreadPoolExecutor
 
 collector = Blueprint('collector', __name__)
@@ -21,93 +28,208 @@ def calibration(gesture, **kwargs):
     if not device_name.isalpha():
         return make_response((f'"{device_name}" is not a valid device name', 400))
 
-    device_conf: dict = current_app.config.get('BIOX_DEVICES', {}).get(device_name, {})
+    index = get_index()
+    device = index.by_name(device_name)
 
-    port = get_biox_device_port(device_conf.get('serial_number', ''))
-
-    if not port:
+    if not device:
         return make_response(('BIOX device not found, make sure it is connected and try again.', 500))
 
     # settings
-    num_sensors = device_conf.get('sensors', 8)
     threshold = kwargs.get('threshold', 117)
     num_to_max = kwargs.get('num_to_max', 2)
 
-    # initialize
-    maxed_sensors = 0
-
     try:
-        biox = BIOX(port.device, sensors=num_sensors)
-        biox.calibration.reset()
-
-        while True:
-            biox.fill_input_buffer()
-            reading = biox.readline()
-            maxed_sensors = len([i for i in reading if i > threshold])
-            if maxed_sensors >= num_to_max:
-                break
-            else:
-                biox.calibration.increment()
+        with pool.lease(device.serial_number, device.port.device, sensors=device.sensors) as biox:
+            result = calibrate(biox, threshold, num_to_max)
     except SerialException as err:
+        index.invalidate()
         return make_response(('BIOX device closed the connection prematurely', 500))
     else:
-        biox.close()
-        return json.jsonify((reading, biox.calibration.iterations))
+        print(f'Calibrated {device.name} in {result.iterations} iterations using {result.reads} reads')
+        return json.jsonify((result.reading, result.iterations))
 
 
-@collector.route('data/')
-def data():
-    ports = get_biox_device_ports()
+@collector.route('/calibration/')
+def calibration_all(**kwargs):
+    index = get_index()
+    devices = index.devices()
 
-    if not any(ports):
+    if not any(devices):
         return make_response(('A BIOX device was not found, make sure all devices are connected and try again.', 500))
 
+    # every configured device needs a calibration, or the subject drops out of the training view
+    missing = index.missing()
+    if missing:
+        return make_response((f'BIOX device(s) {", ".join(missing)} not found, make sure all devices are connected and try again.', 500))
+
+    # settings
+    threshold = kwargs.get('threshold', 117)
+    num_to_max = kwargs.get('num_to_max', 2)
+
+    def run(device: Device):
+        with pool.lease(device.serial_number, device.port.device, sensors=device.sensors) as biox:
+            return calibrate(biox, threshold, num_to_max)
+
     try:
-        bioxes: List[BIOX] = []
-        data = []
+        with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+            results = dict(zip([device.name for device in devices], executor.map(run, devices)))
+    except SerialException as err:
+        index.invalidate()
+        return make_response(('BIOX device closed the connection prematurely', 500))
+    else:
+        for name, result in results.items():
+            print(f'Calibrated {name} in {result.iterations} iterations using {result.reads} reads')
+        return json.jsonify({name: (result.reading, result.iterations) for name, result in results.items()})
 
-        for port in ports:
-            num_sensors = next(device.get('num_sensors') for device in current_app.config.get(
-                'BIOX_DEVICES').values() if port.serial_number in device.get('serial_number'))
-            biox = BIOX(port.device, sensors=num_sensors)
-            bioxes.append(biox)
 
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            t_end = time.perf_counter() + current_app.config.get('TEST_TIME', 5)
-            t_curr = time.perf_counter()
-            while t_curr < t_end:
-                data.append((list(executor.map(fetch_data, bioxes)), t_curr))
-                elapsed = time.perf_counter() - t_curr
-                while(elapsed < .001):
-                    elapsed = time.perf_counter() - t_curr
-                t_curr = time.perf_counter()
+@collector.route('data/')
+def data():
+    index = get_index()
+    devices = index.devices()
+
+    if not any(devices):
+        return make_response(('A BIOX device was not found, make sure all devices are connected and try again.', 500))
 
+    aligned = request.args.get('aligned', '').lower() in ('1', 'true', 'yes', 'on')
+
+    try:
+        data, stats, skews = collect(devices, current_app.config.get('SAMPLE_RATE', 1000),
+                                     current_app.config.get('TEST_TIME', 5), aligned=aligned)
     except SerialException as err:
+        index.invalidate()
         return make_response(('BIOX device closed the connection prematurely', 500))
     else:
-        return json.jsonify(data)
-    finally:
-        [biox.close() for biox in bioxes if biox]
+        response = json.jsonify(data)
+        response.headers['X-Sampling-Stats'] = json.dumps(stats._asdict())
+        response.headers['X-Device-Skew'] = json.dumps(skews)
+        return response
 
 
-def get_biox_device_port(serial_number) -> ListPortInfo:
-    """Gets the port of a biox device based on the serial number associated with key"""
-    port = next(port for port in list_ports.comports()
-                if port.serial_number == serial_number)
-    return port
+@collector.route('jobs/', methods=('POST',))
+def start_job():
+    metadata = request.get_json(silent=True) or request.form
+    try:
+        subject_id, gesture, repetition = int(metadata['subject_id']), str(
+            metadata['gesture']), int(metadata['repetition'])
+    except (KeyError, ValueError):
+        return make_response(('A job needs a subject_id, gesture and repetition', 400))
 
+    index = get_index()
+    devices = index.devices()
 
-def get_biox_device_ports() -> List[ListPortInfo]:
-    """Gets the ports associated with a biox device"""
-    return [port for port in list_ports.comports() if is_biox_device(port)]
+    if not any(devices):
+        return make_response(('A BIOX device was not found, make sure all devices are connected and try again.', 500))
+
+    app = current_app._get_current_object()
+    rate = app.config.get('SAMPLE_RATE', 1000)
+    duration = app.config.get('TEST_TIME', 5)
+
+    def run(job: Job):
+        def progress(count, frame):
+            job.update(progress=min(count / (rate * duration), 1.), preview=frame)
+
+        try:
+            data, stats, _ = collect(devices, rate, duration, progress=progress)
+        except SerialException:
+            index.invalidate()
+            raise
+
+        with app.app_context():
+            store_repetition({'subject_id': subject_id, 'gesture': gesture, 'repetition': repetition},
+                             db.data_rows(subject_id, gesture, repetition, data))
+        return stats._asdict()
+
+    job = jobs.submit(run)
+    return make_response((json.jsonify(job.status()), 202))
+
+
+@collector.route('ingest/')
+def ingest_metrics():
+    worker = current_app.extensions.get('ingest')
+    if worker is None:
+        return make_response(('Background ingest is not enabled', 404))
+    return json.jsonify(worker.metrics())
+
+
+@collector.route('jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response((f'Job "{job_id}" not found', 404))
+    return json.jsonify(job.status())
+
+
+@collector.route('jobs/<job_id>/events')
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response((f'Job "{job_id}" not found', 404))
 
+    def stream():
+        version = -1
+        while True:
+            status = job.wait(version, timeout=15)
+            if status['version'] == version:
+                # Keep the connection alive while nothing happens
+                yield ': keep-alive\n\n'
+                continue
+            version = status['version']
+            yield f'data: {json.dumps(status)}\n\n'
+            if job.done:
+                return
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+def collect(devices: List[Device], rate: float, duration: float, aligned=False, progress=None) -> tuple:
+    """
+    Sample all devices at rate Hz for duration seconds.
+    Progress, if given, is called with the number of frames sampled and the latest frame every tenth of a second.
+    Returns the data points along with the sampling statistics and the skew of each device against the first.
+    """
+    with ExitStack() as stack:
+        bioxes: List[BIOX] = []
+
+        for device in devices:
+            bioxes.append(stack.enter_context(
+                pool.lease(device.serial_number, device.port.device, sensors=device.sensors)))
+
+        scheduler = Scheduler(rate)
+        report_every = max(int(rate / 10), 1)
+        count = 0
+
+        def sample(t_curr):
+            nonlocal count
+            frame = (*zip(*executor.map(fetch_data, bioxes)), t_curr)
+            count += 1
+            if progress and count % report_every == 0:
+                progress(count, frame[0])
+            return frame
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            data, stats = scheduler.run(sample, duration)
+
+    print(f'Sampled at {stats.rate:.1f} Hz, p50 {stats.p50 * 1000:.3f} ms, '
+          f'p99 {stats.p99 * 1000:.3f} ms, {stats.overruns} overruns')
+
+    # (readings, device timestamps, timestamp) per frame
+    readings, device_timestamps, timestamps = zip(*data)
+    device_timestamps = np.array(device_timestamps).T
+    skews = [estimate_skew(device_timestamps[0], t)._asdict()
+             for t in device_timestamps[1:]]
+
+    if aligned:
+        readings = [np.array([frame[i] for frame in readings]) for i in range(len(bioxes))]
+        base, aligned = align(readings, device_timestamps, scheduler.rate)
+        data = list(zip(aligned.tolist(), base.tolist()))
+    else:
+        data = [(frame, t, list(t_devices)) for frame, t, t_devices in zip(
+            readings, timestamps, device_timestamps.T.tolist())]
 
-def is_biox_device(port: ListPortInfo) -> bool:
-    """Check if port is associated with a biox device"""
-    return port.serial_number in [device.get('serial_number') for device in current_app.config.get('BIOX_DEVICES').values()]
+    return data, stats, skews
 
 
 def fetch_data(device: BIOX):
     device.fill_input_buffer()
     line = device.readline()
-    return line
+    return line, time.perf_counter()
@@ -1,9 +1,19 @@
+import numpy as np
 import numpy.random as random
 import datetime
 import time
+import atexit
+import csv
+import io
+import threading
+import typing
+import uuid
+from contextlib import contextmanager
 from configparser import ConfigParser
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from flask import current_app
 
 SCHEMA = {
@@ -25,8 +35,10 @@ SCHEMA = {
         gesture VARCHAR(32) NOT NULL,
         repetition SMALLINT NOT NULL CHECK (repetition >= 0 AND repetition <= 10),
         reading_count INTEGER NOT NULL CHECK (reading_count >= 0),
-        timestamp TIME (6) NOT NULL,
+        timestamp TIME (6),
         readings SMALLINT[][] NOT NULL, 
+        timestamp_ns BIGINT CHECK (timestamp_ns >= 0),
+        CHECK (timestamp IS NOT NULL OR timestamp_ns IS NOT NULL),
         PRIMARY KEY (subject_id, gesture, repetition, reading_count)
     )
     """,
@@ -46,10 +58,52 @@ SCHEMA = {
         FROM calibration AS wrist 
         JOIN calibration AS arm ON (arm.subject_id=wrist.subject_id AND arm.calibration_gesture LIKE 'arm%' AND wrist.calibration_gesture LIKE 'wrist%')
     """,
+    'data_packed': """
+    CREATE TABLE data_packed (
+        subject_id INTEGER NOT NULL REFERENCES subjects (subject_id) ON DELETE CASCADE,
+        gesture VARCHAR(32) NOT NULL,
+        repetition SMALLINT NOT NULL CHECK (repetition >= 0 AND repetition <= 10),
+        reading_count INTEGER NOT NULL CHECK (reading_count >= 0),
+        sensors SMALLINT NOT NULL CHECK (sensors > 0),
+        started_at TIME (6) NOT NULL,
+        readings BYTEA NOT NULL,
+        timestamps BYTEA NOT NULL,
+        PRIMARY KEY (subject_id, gesture, repetition)
+    )
+    """,
+    'data_expanded_view': """
+    CREATE VIEW data_expanded AS 
+        SELECT packed.subject_id, packed.gesture, packed.repetition, expanded.reading_count,
+            packed.started_at + (('x' || encode(substring(packed.timestamps FROM expanded.reading_count * 8 + 1 FOR 8), 'hex'))::bit(64)::bigint / 1000) * INTERVAL '1 microsecond' AS timestamp,
+            ARRAY(SELECT get_byte(packed.readings, expanded.reading_count * packed.sensors + sensor) 
+                  FROM generate_series(0, packed.sensors - 1) AS sensor)::SMALLINT[] AS readings,
+            ('x' || encode(substring(packed.timestamps FROM expanded.reading_count * 8 + 1 FOR 8), 'hex'))::bit(64)::bigint AS timestamp_ns
+        FROM data_packed AS packed
+        CROSS JOIN LATERAL generate_series(0, packed.reading_count - 1) AS expanded(reading_count)
+    """,
+    'data_all_view': """
+    CREATE VIEW data_all AS 
+        SELECT subject_id, gesture, repetition, reading_count, timestamp, readings, timestamp_ns FROM data
+        WHERE NOT EXISTS (SELECT 1 FROM data_packed AS packed 
+            WHERE packed.subject_id = data.subject_id AND packed.gesture = data.gesture AND packed.repetition = data.repetition)
+        UNION ALL
+        SELECT subject_id, gesture, repetition, reading_count, timestamp, readings, timestamp_ns FROM data_expanded
+    """,
     'training_view':"""
     CREATE VIEW training AS 
         SELECT * FROM subjects 
-        JOIN data USING (subject_id)
+        JOIN data_all USING (subject_id)
+        JOIN combined_calibration USING (subject_id)
+    """,
+    'training_dataset': """
+    CREATE TABLE training_dataset AS 
+        SELECT * FROM training WITH NO DATA;
+    CREATE INDEX training_dataset_gesture_subject ON training_dataset (gesture, subject_id)
+    """,
+    'training_expanded_view': """
+    CREATE VIEW training_expanded AS 
+        SELECT * FROM subjects 
+        JOIN data_expanded USING (subject_id)
         JOIN combined_calibration USING (subject_id)
     """
 }
@@ -62,33 +116,20 @@ SCHEMA = {
 # region INSERT handling
 
 
-def _insert(sql: str, data, returning: bool = False) -> list:
+def _insert(sql: str, data, returning: bool = False, prepared: bool = False) -> list:
     """ 
-    Insert data into table.
+    Insert data into table. If prepared=True the statement is prepared once per connection.
     """
-    conn = None
     returned = None
-    try:
-        conn = _connect()
+    with transaction() as conn:
         # create a new cursor
-        cur = conn.cursor()
-        # execute the INSERT statement
-        # print(str((*data,)))
-        cur.execute(sql, (*data,))
-
-        # get the generated id back
-        if returning:
-            returned = cur.fetchall()
+        with conn.cursor() as cur:
+            # execute the INSERT statement
+            _execute(cur, sql, (*data,), prepared)
 
-        # commit the changes to the database
-        conn.commit()
-        # close communication with the database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
+            # get the generated id back
+            if returning:
+                returned = cur.fetchall()
 
     return returned
 
@@ -102,7 +143,7 @@ def insert_subject(subject) -> int:
 
     sql = f"INSERT INTO subjects({','.join(columns)}) VALUES ({','.join(['%s' for _ in values])}) RETURNING subject_id;"
 
-    subject_id = _insert(sql, values, returning=True)[0][0]
+    subject_id = _insert(sql, values, returning=True, prepared=True)[0][0]
 
     print(
         f"Inserted {values} for into 'subjects'. Received {subject_id} back.")
@@ -120,12 +161,30 @@ def insert_calibration(calibration) -> None:
     SET calibration_iterations = Excluded.calibration_iterations, calibration_values = Excluded.calibration_values
     ;"""
 
-    _insert(sql, values)
+    _insert(sql, values, prepared=True)
 
     print(f"Inserted {values} for into 'calibration'.")
     return
 
 
+def insert_calibrations(calibrations) -> None:
+    """ 
+    Insert several calibrations into the calibration table at once.
+    """
+    columns = calibrations[0].keys()
+    values = [(*x.values(),) for x in calibrations]
+
+    sql = f"""INSERT INTO calibration({','.join(columns)}) VALUES %s 
+    ON CONFLICT (subject_id, calibration_gesture) DO UPDATE 
+    SET calibration_iterations = Excluded.calibration_iterations, calibration_values = Excluded.calibration_values
+    ;"""
+
+    _insert_many(sql, values)
+
+    print(f"Inserted {len(values)} calibrations into 'calibration'.")
+    return
+
+
 def insert_data(data) -> None:
     """ 
     Insert new data point into the data table.
@@ -136,7 +195,7 @@ def insert_data(data) -> None:
     ON CONFLICT (subject_id, gesture, repetition, reading_count) DO NOTHING
     ;"""
 
-    _insert(sql, values)
+    _insert(sql, values, prepared=True)
 
     #print(f"Inserted {values} for into 'data'.")
     return
@@ -146,30 +205,77 @@ def _insert_many(sql, values) -> None:
     """ 
     Insert lots of data into table.
     """
-    conn = None
-    try:
-        conn = _connect()
+    with transaction() as conn:
         # create a new cursor
-        cur = conn.cursor()
-        # execute the sql statement
-        execute_values(cur, sql, values)
-
-        # commit the changes to the database
-        conn.commit()
-        # close communication with the database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
+        with conn.cursor() as cur:
+            # execute the sql statement
+            execute_values(cur, sql, values)
     return
 
 
-def insert_data_repetition(repetition_data) -> None:
+def data_rows(subject_id, gesture, repetition, data, numeric=None) -> list:
+    """
+    Construct the rows of a repetition from the collected (reading, timestamp) data points.
+    If numeric, timestamps are stored as integer nanoseconds since the first data point 
+    instead of a time of day, defaulting to the NUMERIC_TIMESTAMPS of the flask config.
+    """
+    if numeric is None:
+        numeric = current_app.config.get('NUMERIC_TIMESTAMPS', True) if current_app else True
+
+    # readings collected per device come as tuples, which psycopg2 would send as records
+    readings = [_array_value(item[0]) for item in data]
+    timestamps = np.array([item[1] for item in data], dtype=np.float64)
+    columns = ['subject_id', 'gesture', 'repetition', 'reading_count', 'readings']
+
+    if numeric:
+        columns.append('timestamp_ns')
+        timestamps = to_relative_ns(timestamps).tolist()
+    else:
+        columns.append('timestamp')
+        timestamps = [time.strftime("%H:%M:%S", time.localtime(t)) + f".{int(t % 1 * 10**6):06d}"
+                      for t in timestamps.tolist()]
+
+    return [dict(zip(columns, (subject_id, gesture, repetition, count, reading, timestamp)))
+            for count, (reading, timestamp) in enumerate(zip(readings, timestamps))]
+
+
+def _array_value(value):
+    """
+    Convert a (nested) sequence of readings to nested lists, which psycopg2 sends as an array.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_array_value(v) for v in value]
+    return value
+
+
+def to_relative_ns(timestamps) -> np.ndarray:
+    """
+    Convert timestamps in seconds, e.g. from perf_counter, to int64 nanoseconds since the first one.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if not len(timestamps):
+        return np.zeros(0, dtype=np.int64)
+    return np.rint((timestamps - timestamps[0]) * 10**9).astype(np.int64)
+
+
+def insert_data_repetition(repetition_data, method=None) -> None:
     """
     Insert all data from repetition.
+    Method is either 'values' (INSERT ... VALUES), 'copy' (COPY FROM STDIN) or 'packed'
+    (one data_packed row), defaulting to the INGEST_METHOD of the flask config.
     """
+    if method is None:
+        method = current_app.config.get('INGEST_METHOD', 'values') if current_app else 'values'
+
+    if method == 'copy':
+        copy_data(repetition_data)
+        return
+    if method == 'packed':
+        insert_packed_repetition(repetition_data)
+        return
+
     start = time.perf_counter()
     columns = repetition_data[0].keys()
     values = [(*x.values(),) for x in repetition_data]
@@ -178,7 +284,248 @@ def insert_data_repetition(repetition_data) -> None:
     ;"""
     _insert_many(sql, values)
     elapsed = time.perf_counter() - start
-    print(f'Inserted {len(values)} data points in {elapsed} seconds')
+    print(f'Inserted {len(values)} data points in {elapsed} seconds ({len(values) / elapsed:.0f} rows/s)')
+
+
+def replace_repetition(metadata, repetition_data, method=None) -> None:
+    """
+    Atomically replace the data of the repetition identified by metadata 
+    (subject_id, gesture and repetition) with repetition_data.
+    Method is as for insert_data_repetition.
+    """
+    replace_repetitions([(metadata, repetition_data)], method)
+
+
+def replace_repetitions(repetitions, method=None) -> None:
+    """
+    Replace the data of several (metadata, repetition_data) repetitions in a single transaction, 
+    see replace_repetition.
+    """
+    if method is None:
+        method = current_app.config.get('INGEST_METHOD', 'values') if current_app else 'values'
+
+    start = time.perf_counter()
+    rows = 0
+
+    with transaction() as conn:
+        with conn.cursor() as cur:
+            for metadata, repetition_data in repetitions:
+                _replace_repetition(cur, metadata, repetition_data, method)
+                rows += len(repetition_data)
+
+    elapsed = time.perf_counter() - start
+    print(f'Replaced {len(repetitions)} repetition(s) with {rows} data points in {elapsed} seconds')
+
+
+def _replace_repetition(cur, metadata, repetition_data, method) -> None:
+    """
+    Replace the data of a single repetition on cursor, see replace_repetition.
+    """
+    key = (metadata['subject_id'], metadata['gesture'], metadata['repetition'])
+    delete_data = cur.mogrify(
+        "DELETE FROM data WHERE (subject_id = %s AND gesture = %s AND repetition = %s);", key).decode()
+    # a repetition lives in either data or data_packed, drop it from both
+    delete = delete_data + cur.mogrify(
+        "DELETE FROM data_packed WHERE (subject_id = %s AND gesture = %s AND repetition = %s);", key).decode()
+
+    if not repetition_data:
+        cur.execute(delete)
+    elif method == 'copy':
+        cur.execute(delete)
+        _copy_data(cur, repetition_data)
+    elif method == 'packed':
+        # the upsert replaces the packed row by itself
+        cur.execute(delete_data)
+        cur.execute(*_packed_upsert(pack_repetition(repetition_data)))
+    else:
+        columns = repetition_data[0].keys()
+        values = [(*x.values(),) for x in repetition_data]
+        # send the delete along with the insert in a single statement
+        sql = delete.replace('%', '%%') + f"""
+        INSERT INTO data({','.join(columns)}) VALUES %s
+        ON CONFLICT (subject_id, gesture, repetition, reading_count) DO NOTHING
+        ;"""
+        execute_values(cur, sql, values, page_size=len(values))
+
+
+def pack_repetition(repetition_data) -> dict:
+    """
+    Pack the rows of a single repetition into one data_packed row.
+    Readings are stored as uint8 bytes in reading_count order, timestamps as 
+    big-endian int64 nanoseconds since the first reading.
+    Rows may carry either a time of day timestamp or a numeric timestamp_ns.
+    """
+    repetition_data = sorted(repetition_data, key=lambda row: row['reading_count'])
+    first = repetition_data[0]
+
+    readings = np.array([np.hstack(row['readings']) for row in repetition_data])
+    if first.get('timestamp') is None:
+        # numeric timestamps have no time of day, the expanded times count from midnight
+        offsets = np.array([row['timestamp_ns'] for row in repetition_data], dtype=np.int64)
+        offsets -= offsets[0]
+        started_at = '00:00:00'
+    else:
+        micros = np.array([_time_to_micros(row['timestamp']) for row in repetition_data], dtype=np.int64)
+        # TIME wraps at midnight
+        offsets = (micros - micros[0]) % (24 * 60 * 60 * 10**6) * 1000
+        started_at = first['timestamp']
+
+    return {
+        'subject_id': first['subject_id'],
+        'gesture': first['gesture'],
+        'repetition': first['repetition'],
+        'reading_count': len(readings),
+        'sensors': readings.shape[1],
+        'started_at': started_at,
+        'readings': np.clip(readings, 0, 255).astype(np.uint8).tobytes(),
+        'timestamps': offsets.astype('>i8').tobytes(),
+    }
+
+
+def _time_to_micros(value) -> int:
+    """
+    Convert a TIME value, or its 'HH:MM:SS.ffffff' text form, to microseconds since midnight.
+    """
+    if isinstance(value, datetime.time):
+        return ((value.hour * 60 + value.minute) * 60 + value.second) * 10**6 + value.microsecond
+    hours, minutes, seconds = str(value).split(':')
+    return (int(hours) * 60 + int(minutes)) * 60 * 10**6 + round(float(seconds) * 10**6)
+
+
+def insert_packed_repetition(repetition_data) -> None:
+    """
+    Insert all data from repetition as a single data_packed row, replacing any earlier one.
+    """
+    start = time.perf_counter()
+    packed = pack_repetition(repetition_data)
+    _insert(*_packed_upsert(packed))
+    elapsed = time.perf_counter() - start
+    print(f'Inserted {packed["reading_count"]} packed data points in {elapsed} seconds')
+
+
+def _packed_upsert(packed) -> tuple:
+    """
+    Build the statement and values upserting a packed repetition into data_packed.
+    """
+    columns, values = packed.keys(), [psycopg2.Binary(v) if isinstance(v, bytes) else v for v in packed.values()]
+
+    sql = f"""INSERT INTO data_packed({','.join(columns)}) VALUES ({','.join(['%s' for _ in values])}) 
+    ON CONFLICT (subject_id, gesture, repetition) DO UPDATE 
+    SET reading_count = Excluded.reading_count, sensors = Excluded.sensors, started_at = Excluded.started_at,
+        readings = Excluded.readings, timestamps = Excluded.timestamps
+    ;"""
+    return sql, values
+
+
+def copy_data(rows, columns=None) -> int:
+    """
+    Stream rows into the data table with COPY FROM STDIN, without building the statement in memory.
+    Rows is an iterable of dicts, or of tuples ordered as columns. The rows are copied into a 
+    temporary staging table first, so conflicting rows are skipped like insert_data_repetition does.
+    Returns the number of rows inserted.
+    """
+    start = time.perf_counter()
+    with transaction() as conn:
+        with conn.cursor() as cur:
+            copied, inserted = _copy_data(cur, rows, columns)
+
+    elapsed = time.perf_counter() - start
+    print(f'Copied {copied} data points in {elapsed} seconds ({copied / elapsed:.0f} rows/s), {inserted} inserted')
+    return inserted
+
+
+def _copy_data(cur, rows, columns=None) -> tuple:
+    """
+    Copy rows into the data table through a staging table on cursor, see copy_data.
+    Returns the number of rows copied and inserted.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0, 0
+
+    if isinstance(first, dict):
+        columns = columns or list(first.keys())
+        rows = ((*row.values(),) for row in _chain(first, rows))
+    else:
+        rows = _chain(first, rows)
+    columns = ','.join(columns)
+
+    copied = 0
+
+    def counted():
+        nonlocal copied
+        for row in rows:
+            copied += 1
+            yield row
+
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS data_staging (LIKE data INCLUDING DEFAULTS) ON COMMIT DROP;")
+    cur.copy_expert(f"COPY data_staging({columns}) FROM STDIN WITH (FORMAT csv);",
+                    _CSVStream(counted()))
+    cur.execute(f"""INSERT INTO data({columns}) SELECT {columns} FROM data_staging
+    ON CONFLICT (subject_id, gesture, repetition, reading_count) DO NOTHING
+    ;""")
+    inserted = cur.rowcount
+    # the staging table lives until commit, empty it for the next copy in the transaction
+    cur.execute("TRUNCATE data_staging;")
+    return copied, inserted
+
+
+def copy_data_array(subject_id, gesture, repetition, readings, timestamps) -> int:
+    """
+    Stream a repetition held as a (n, sensors) readings array and n timestamps into the data table.
+    """
+    return copy_data(((subject_id, gesture, repetition, count, reading, timestamp)
+                      for count, (reading, timestamp) in enumerate(zip(readings.tolist(), timestamps))),
+                     ['subject_id', 'gesture', 'repetition', 'reading_count', 'readings', 'timestamp'])
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def _array_literal(value) -> str:
+    """
+    Render a (nested) sequence as a PostgreSQL array literal.
+    """
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(_array_literal(v) for v in value) + '}'
+    return str(value)
+
+
+class _CSVStream():
+    """
+    File-like object rendering rows as CSV on demand, for cursor.copy_expert.
+    """
+
+    def __init__(self, rows, chunk_rows=1000):
+        self.rows = rows
+        self.chunk_rows = chunk_rows
+        self.buffer = ''
+
+    def _render(self) -> bool:
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        for _, row in zip(range(self.chunk_rows), self.rows):
+            writer.writerow([_array_literal(v) if isinstance(v, (list, tuple)) else v for v in row])
+        self.buffer += out.getvalue()
+        return bool(out.tell())
+
+    def read(self, size=-1) -> str:
+        while (size < 0 or len(self.buffer) < size) and self._render():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1) -> str:
+        while '\n' not in self.buffer and self._render():
+            pass
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
 # endregion
 
 # region DELETE handling
@@ -188,26 +535,19 @@ def _delete(table: str, condition: str, args) -> int:
     """ 
     Delete rows from table where condition matches.
     """
-    conn = None
+    sql = f"DELETE FROM {table} WHERE {condition};"
     try:
-        conn = _connect()
-        cur = conn.cursor()
-        sql = f"DELETE FROM {table} WHERE {condition};"
-        # execute the DELETE  statement
-        cur.execute(sql, args)
-        # get the number of updated rows
-        rows_deleted = cur.rowcount
-        print(f"Deleted {rows_deleted} row(s).")
-        # Commit the changes to the database
-        conn.commit()
-        # Close communication with the PostgreSQL database
-        cur.close()
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                # execute the DELETE  statement
+                cur.execute(sql, args)
+                # get the number of updated rows
+                rows_deleted = cur.rowcount
+                print(f"Deleted {rows_deleted} row(s).")
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
         raise error
-    finally:
-        if conn is not None:
-            conn.close()
+    return rows_deleted
 
 
 def delete_subject(subject_id) -> int:
@@ -252,24 +592,20 @@ def get_all(table, annotated=False) -> list:
     """ 
     Get all rows from table.
     """
-    conn = None
+    result = None
     try:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(f"SELECT * FROM {table}")
-        print("The number of entries: ", cur.rowcount)
-        
-        # get the result back
-        result = cur.fetchall()
-        if annotated: 
-            colnames = [desc[0] for desc in cur.description]
-            result = [y for y in map(lambda x: dict(zip(colnames, x)), result)]
-        cur.close()
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT * FROM {table}")
+                print("The number of entries: ", cur.rowcount)
+
+                # get the result back
+                result = cur.fetchall()
+                if annotated: 
+                    colnames = [desc[0] for desc in cur.description]
+                    result = [y for y in map(lambda x: dict(zip(colnames, x)), result)]
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
     return result
 
 def get_equals(table, context, annotated=False) -> list:
@@ -279,58 +615,69 @@ def get_equals(table, context, annotated=False) -> list:
     columns, values = context.keys(), context.values()
     where = ' AND '.join(['='.join([column, '%s']) for column in columns])
     sql = f"SELECT * FROM {table} WHERE ({where});"
-    result = None
-    conn = None
-    try:
-        conn = _connect()
-        # create a new cursor
-        cur = conn.cursor()
-        # execute the sql statement
-        cur.execute(sql, (*values,))
-        # get the result back
-        result = cur.fetchall()
-        if annotated: 
-            colnames = [desc[0] for desc in cur.description]
-            result = [y for y in map(lambda x: dict(zip(colnames, x)), result)]
-        # close communication with the database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
-    return result
+    return _select(sql, values, annotated, prepared=True)
 
 def get_where(table, where, values, annotated=False) -> list:
     """ 
     Get all rows from table matching where statement. If anotated=True will return as tuples (column_name, value,).
     """
     sql = f"SELECT * FROM {table} WHERE ({where});"
+    return _select(sql, values, annotated)
+
+def _select(sql, values, annotated=False, prepared=False) -> list:
+    """ 
+    Get all rows returned by sql. If anotated=True will return as tuples (column_name, value,).
+    If prepared=True the statement is prepared once per connection.
+    """
     result = None
-    conn = None
-    try:
-        conn = _connect()
+    with transaction() as conn:
         # create a new cursor
-        cur = conn.cursor()
-        # execute the sql statement
-        cur.execute(sql, (*values,))
-
-        # get the result back
-        result = cur.fetchall()
-        if annotated: 
-            colnames = [desc[0] for desc in cur.description]
-            result = [y for y in map(lambda x: dict(zip(colnames, x)), result)]
-
-        # close communication with the database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
-
+        with conn.cursor() as cur:
+            # execute the sql statement
+            _execute(cur, sql, (*values,), prepared)
+
+            # get the result back
+            result = cur.fetchall()
+            if annotated: 
+                colnames = [desc[0] for desc in cur.description]
+                result = [y for y in map(lambda x: dict(zip(colnames, x)), result)]
     return result
 
+def iter_all(table, itersize=10000, columnar=False, order_by=None, columns=None) -> typing.Iterator:
+    """ 
+    Stream all rows from table in batches of itersize rows using a server-side cursor.
+    Batches are lists of tuples, or if columnar=True dicts of column_name: numpy array.
+    Columns limits the columns selected.
+    """
+    order = f" ORDER BY {order_by}" if order_by else ""
+    selected = ','.join(columns) if columns else '*'
+    return _iter_select(f"SELECT {selected} FROM {table}{order}", (), itersize, columnar)
+
+def iter_where(table, where, values, itersize=10000, columnar=False) -> typing.Iterator:
+    """ 
+    Stream all rows from table matching where statement in batches of itersize rows, see iter_all.
+    """
+    return _iter_select(f"SELECT * FROM {table} WHERE ({where})", values, itersize, columnar)
+
+def _iter_select(sql, values, itersize=10000, columnar=False) -> typing.Iterator:
+    """ 
+    Stream the rows returned by sql in batches through a named server-side cursor,
+    so only a single batch is held in memory at a time.
+    """
+    with transaction() as conn:
+        with conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cur:
+            cur.itersize = itersize
+            cur.execute(sql, (*values,))
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                if columnar:
+                    colnames = [desc[0] for desc in cur.description]
+                    yield {name: np.array(column) for name, column in zip(colnames, zip(*rows))}
+                else:
+                    yield rows
+
 def exists(table, context) -> bool:
     """
     Checks if table contains any rows matching the context
@@ -339,22 +686,13 @@ def exists(table, context) -> bool:
     where = ' AND '.join(['='.join([column, '%s']) for column in columns])
     sql = f"SELECT EXISTS(SELECT 1 FROM {table} WHERE ({where}));"
     exists = False
-    conn = None
-    try:
-        conn = _connect()
+    with transaction() as conn:
         # create a new cursor
-        cur = conn.cursor()
-        # execute the sql statement
-        cur.execute(sql, (*values,))
-        # get the result back
-        exists = cur.fetchone()[0]
-        # close communication with the database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
+        with conn.cursor() as cur:
+            # execute the sql statement
+            _execute(cur, sql, (*values,), prepared=True)
+            # get the result back
+            exists = cur.fetchone()[0]
 
     return exists
 # endregion
@@ -392,40 +730,173 @@ def setup(schema=SCHEMA):
     """ 
     Create tables in the PostgreSQL database.
     """
-    conn = None
     try:
-        conn = _connect()
-        cur = conn.cursor()
-        # create table one by one
-        for command in schema.values():
-            cur.execute(command)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                # create table one by one
+                for command in schema.values():
+                    cur.execute(command)
         print('Exoskelebox setup complete.')
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
-def _connect(config={}):
+class _Connection(psycopg2.extensions.connection):
+    """
+    Connection remembering the statements prepared on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class _Statements():
+    """
+    Registry of prepared statements, keyed by their SQL text, 
+    which is determined by the table and column set of the statement.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def execute(self, cur, sql: str, values) -> None:
+        """
+        Execute sql on cursor, preparing it first if the connection has not done so yet.
+        """
+        with self._lock:
+            name = self.names.get(sql)
+            if name is None:
+                name = self.names[sql] = f'statement_{len(self.names)}'
+
+        conn = cur.connection
+        if name in conn.prepared:
+            self.hits += 1
+        else:
+            self.misses += 1
+            # number the %s placeholders as $1, $2, ...
+            parts = sql.strip().rstrip(';').split('%s')
+            numbered = parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+            cur.execute(f"PREPARE {name} AS {numbered};")
+            conn.prepared.add(name)
+
+        if values:
+            cur.execute(f"EXECUTE {name} ({','.join(['%s' for _ in values])});", values)
+        else:
+            cur.execute(f"EXECUTE {name};")
+
+    def stats(self) -> dict:
+        return {'statements': len(self.names), 'hits': self.hits, 'misses': self.misses}
+
+
+_statements = _Statements()
+
+
+def _execute(cur, sql: str, values, prepared: bool = False) -> None:
+    """ 
+    Execute sql on cursor, as a prepared statement if prepared=True.
+    """
+    if prepared:
+        _statements.execute(cur, sql, values)
+    else:
+        cur.execute(sql, values)
+
+
+def statement_stats() -> dict:
+    """ 
+    Get the number of distinct prepared statements along with the cache hits and misses.
+    """
+    return _statements.stats()
+
+
+class _Pool():
+    """
+    Thread-safe pool of connections to one database. 
+    Blocks rather than fail when every connection is in use.
+    """
+
+    def __init__(self, config: dict):
+        config = dict(config)
+        minconn = int(config.pop('minconn', 1))
+        maxconn = int(config.pop('maxconn', 10))
+        self._pool = ThreadedConnectionPool(minconn, maxconn, connection_factory=_Connection, **config)
+        self._available = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self._available.acquire()
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
+
+    def putconn(self, conn) -> None:
+        try:
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._available.release()
+
+    def closeall(self) -> None:
+        self._pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(config={}) -> _Pool:
     """ 
-    Connect to the database server.
+    Get the connection pool of the configured database, creating it on first use.
+    The pool is sized by the optional 'minconn' and 'maxconn' configuration keys.
     """
     if not config:
         config = _config()
 
-    conn = None
+    key = tuple(sorted((k, str(v)) for k, v in config.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = _Pool(config)
+        return _pools[key]
+
+
+@contextmanager
+def transaction(config={}):
+    """ 
+    Borrow a pooled connection for the duration of the block. 
+    Commits when the block completes and rolls back if it raises.
+    """
+    pool = _pool(config)
+    conn = pool.getconn()
     try:
-        # connect to the PostgreSQL database
-        conn = psycopg2.connect(**config)
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-        raise error
-    return conn
+        yield conn
+        conn.commit()
+    except:
+        if not conn.closed:
+            conn.rollback()
+            if conn.prepared:
+                # statements prepared in the failed transaction may be gone, start over
+                conn.cursor().execute("DEALLOCATE ALL;")
+                conn.commit()
+                conn.prepared.clear()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def close_pools() -> None:
+    """ 
+    Close every pooled connection.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+atexit.register(close_pools)
 
 
 def reset(table: str, cascade: bool = False) -> None:
@@ -433,30 +904,117 @@ def reset(table: str, cascade: bool = False) -> None:
     Drop table and recreate.
     """
     if table in SCHEMA.keys():
-        conn = None
         try:
-            conn = _connect()
-            cur = conn.cursor()
-            sql = f"DROP TABLE IF EXISTS {table}{' CASCADE' if cascade else ''};"
-            cur.execute(sql)
-            conn.commit()
-            cur.close()
-            print(f"Dropped table '{table}'")
-
-            cur = conn.cursor()
-            cur.execute(SCHEMA[table])
-            print(f"Recreated table '{table}'")
-            conn.commit()
-            cur.close()
+            with transaction() as conn:
+                with conn.cursor() as cur:
+                    sql = f"DROP TABLE IF EXISTS {table}{' CASCADE' if cascade else ''};"
+                    cur.execute(sql)
+                    print(f"Dropped table '{table}'")
+
+                    cur.execute(SCHEMA[table])
+                    print(f"Recreated table '{table}'")
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
-        finally:
-            if conn is not None:
-                conn.close()
     else:
         print(f"Error: '{table}' not in schema.")
 
 
+def refresh_training(subject_id=None) -> None:
+    """ 
+    Refresh the materialised training_dataset table from the training view.
+    With a subject_id only the rows of that subject are replaced, otherwise the table is 
+    rebuilt from scratch, ordered by (gesture, subject_id) to match its index.
+    The table is rebuilt as well when its columns no longer match those of the view.
+    """
+    start = time.perf_counter()
+    try:
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                columns = _columns(cur, 'training')
+                if subject_id is not None and _columns(cur, 'training_dataset') != columns:
+                    print("training_dataset is out of date with the training view, rebuilding it")
+                    subject_id = None
+
+                if subject_id is None:
+                    cur.execute("DROP TABLE IF EXISTS training_dataset;")
+                    cur.execute("""CREATE TABLE training_dataset AS 
+                        SELECT * FROM training ORDER BY gesture, subject_id, repetition, reading_count;""")
+                    rows = cur.rowcount
+                    cur.execute("CREATE INDEX training_dataset_gesture_subject ON training_dataset (gesture, subject_id);")
+                else:
+                    cur.execute("DELETE FROM training_dataset WHERE subject_id = %s;", (subject_id,))
+                    selected = ','.join(f'"{column}"' for column in columns)
+                    cur.execute(f"INSERT INTO training_dataset ({selected}) SELECT {selected} FROM training WHERE subject_id = %s;", (subject_id,))
+                    rows = cur.rowcount
+                # keep the planner statistics in line with the new rows
+                cur.execute("ANALYZE training_dataset;")
+        print(f"Refreshed training_dataset{'' if subject_id is None else f' for subject {subject_id}'} "
+              f"with {rows} rows in {time.perf_counter() - start} seconds")
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        raise error
+
+
+def _columns(cur, table) -> typing.List[str]:
+    """
+    Get the column names of table or view, in order.
+    """
+    cur.execute("""SELECT column_name FROM information_schema.columns 
+    WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position;""", (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def migrate_timestamps() -> None:
+    """ 
+    Add the numeric timestamp_ns column to an existing data table and fill it in 
+    from the time of day timestamps, relative to the first reading of each repetition.
+    The training view is recreated on top of data_all, creating data_packed if it is missing,
+    and training_dataset is rebuilt from it.
+    """
+    try:
+        with transaction() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP VIEW IF EXISTS training;")
+                cur.execute("DROP VIEW IF EXISTS data_all;")
+                cur.execute("""ALTER TABLE data 
+                    ADD COLUMN IF NOT EXISTS timestamp_ns BIGINT CHECK (timestamp_ns >= 0),
+                    ALTER COLUMN timestamp DROP NOT NULL;""")
+                cur.execute("""UPDATE data SET timestamp_ns = 
+                    round(mod((EXTRACT(EPOCH FROM data.timestamp) - EXTRACT(EPOCH FROM first.timestamp))::numeric + 86400, 86400) * 1e9)::bigint
+                    FROM data AS first 
+                    WHERE first.subject_id = data.subject_id AND first.gesture = data.gesture 
+                        AND first.repetition = data.repetition AND first.reading_count = 0 
+                        AND data.timestamp_ns IS NULL;""")
+                print(f"Filled in {cur.rowcount} numeric timestamps")
+                cur.execute("SELECT to_regclass('data_packed') IS NULL;")
+                if cur.fetchone()[0]:
+                    cur.execute(SCHEMA['data_packed'])
+                    cur.execute(SCHEMA['data_expanded_view'])
+                cur.execute(SCHEMA['data_all_view'])
+                cur.execute(SCHEMA['training_view'])
+        # training_dataset still has the columns of the old view
+        refresh_training()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def migrate_to_packed() -> int:
+    """ 
+    Copy every repetition in the data table that is not in data_packed yet into data_packed.
+    The data table is left untouched, the data_all view reads migrated repetitions from data_packed only.
+    """
+    keys = _select("""SELECT DISTINCT subject_id, gesture, repetition FROM data 
+    EXCEPT SELECT subject_id, gesture, repetition FROM data_packed;""", ())
+    print(f'Migrating {len(keys)} repetitions to data_packed')
+
+    for subject_id, gesture, repetition in keys:
+        rows = get_equals('data', {'subject_id': subject_id, 'gesture': gesture, 'repetition': repetition}, True)
+        insert_packed_repetition(rows)
+
+    print('Migration done')
+    return len(keys)
+
+
 def reset_all() -> None:
     """ 
     Drop all tables and recreate.
@@ -530,6 +1088,11 @@ def _insert_dummies(n=1):
 # endregion
 
 if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ['refresh-training']:
+        refresh_training()
+        sys.exit()
+
     #reset_all()
     #_insert_dummies(10)
     print(get_all('combined_calibration'))
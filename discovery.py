@@ -0,0 +1,105 @@
+import threading
+import time
+import typing
+from flask import current_app
+from serial.tools import list_ports
+from serial.tools.list_ports_common import ListPortInfo
+
+
+class Device(typing.NamedTuple):
+    name: str
+    serial_number: str
+    sensors: int
+    port: ListPortInfo
+
+
+class DeviceIndex():
+    """
+    Index of the configured BIOX devices by serial number.
+    Port enumeration is cached for ttl seconds, or until invalidated.
+    """
+
+    def __init__(self, devices: dict, ttl=10.):
+        self.ttl = ttl
+        self.configured: typing.Dict[str, typing.Tuple[str, int]] = {}
+        self.overrides: typing.Dict[str, str] = {}
+
+        for name, device in devices.items():
+            serial_numbers = device.get('serial_number', [])
+            if isinstance(serial_numbers, str):
+                serial_numbers = [serial_numbers]
+            for serial_number in serial_numbers:
+                self.configured[serial_number] = (
+                    name, device.get('num_sensors', device.get('sensors', 8)))
+                if device.get('port'):
+                    self.overrides[serial_number] = device.get('port')
+
+        self._devices: typing.Dict[str, Device] = {}
+        self._expires = 0.
+        self._lock = threading.Lock()
+
+    def devices(self) -> typing.List[Device]:
+        """
+        Get the configured devices that are currently connected.
+        """
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                self._devices = self._scan()
+                self._expires = time.monotonic() + self.ttl
+            return list(self._devices.values())
+
+    def get(self, serial_number) -> typing.Optional[Device]:
+        """
+        Get the connected device with serial number.
+        """
+        return next((device for device in self.devices() if device.serial_number == serial_number), None)
+
+    def by_name(self, name) -> typing.Optional[Device]:
+        """
+        Get the connected device configured under name.
+        """
+        return next((device for device in self.devices() if device.name == name), None)
+
+    def missing(self) -> typing.List[str]:
+        """
+        Get the names of the configured devices that are not currently connected.
+        """
+        connected = {device.name for device in self.devices()}
+        return sorted({name for name, _ in self.configured.values()} - connected)
+
+    def invalidate(self) -> None:
+        """
+        Force the next lookup to enumerate the ports again, e.g. after a port failed to open.
+        """
+        with self._lock:
+            self._expires = 0.
+
+    def _scan(self) -> typing.Dict[str, Device]:
+        """
+        Enumerate the ports and match them against the configured devices.
+        """
+        ports = list(list_ports.comports())
+        for serial_number, device in self.overrides.items():
+            port = ListPortInfo(device)
+            port.serial_number = serial_number
+            ports.append(port)
+
+        devices = {}
+        for port in ports:
+            if port.serial_number in self.configured:
+                name, sensors = self.configured[port.serial_number]
+                devices[port.serial_number] = Device(
+                    name, port.serial_number, sensors, port)
+        return devices
+
+
+def get_index() -> DeviceIndex:
+    """
+    Get the device index of the current app, building it on first use.
+    """
+    index = current_app.extensions.get('biox_devices')
+    if index is None:
+        index = current_app.extensions['biox_devices'] = DeviceIndex(
+            current_app.config.get('BIOX_DEVICES', {}),
+            current_app.config.get('BIOX_DISCOVERY_TTL', 10.))
+    return index
@@ -0,0 +1,254 @@
+import datetime
+import decimal
+import json
+import os
+import shutil
+import sys
+import time
+import typing
+import numpy as np
+import database as db
+
+MANIFEST = 'manifest.json'
+PARTS = 'parts'
+# Stored in place of NULL in integer and time columns, see column_values
+NULL_INT = np.iinfo(np.int64).min
+
+# The dtypes numeric columns are exported and fed to the model as
+DTYPES = {
+    'subject_id': np.uint16,
+    'subject_age': np.uint8,
+    'subject_fitness': np.uint8,
+    'subject_wrist_circumference': np.float32,
+    'subject_forearm_circumference': np.float32,
+    'repetition': np.uint8,
+    'reading_count': np.uint16,
+    'timestamp_ns': np.int64,
+    'readings': np.uint8,
+    'arm_calibration_iterations': np.uint16,
+    'arm_calibration_values': np.uint8,
+    'wrist_calibration_iterations': np.uint16,
+    'wrist_calibration_values': np.uint8,
+}
+
+
+def export_training(folder, table='training_dataset', itersize=50000) -> dict:
+    """
+    Export table as one .npy file per column, with the rows of every subject kept together
+    and their offsets recorded in a manifest. Every column is stored with a fixed-width dtype,
+    numeric ones narrowed to their DTYPES, so the files can be memory mapped and fed to the model
+    without a copy. Columns holding NULLs get a .valid.npy mask alongside.
+    """
+    start = time.perf_counter()
+    os.makedirs(os.path.join(folder, PARTS), exist_ok=True)
+
+    manifest = {'table': table, 'created': datetime.datetime.utcnow().isoformat(), 'columns': {}, 'shards': []}
+    pending: typing.Dict[str, list] = {}
+    subject_id = None
+
+    def write_part():
+        part = os.path.join(folder, PARTS, f'subject_{subject_id}')
+        os.makedirs(part, exist_ok=True)
+        rows = 0
+        for name, batches in pending.items():
+            array, valid = column_values(np.concatenate(batches))
+            array = narrow(name, array, valid)
+            np.save(os.path.join(part, f'{name}.npy'), array)
+            if valid is not None:
+                np.save(os.path.join(part, f'{name}.valid.npy'), valid)
+            rows = len(array)
+        offset = sum(shard['rows'] for shard in manifest['shards'])
+        manifest['shards'].append({'subject_id': subject_id, 'rows': rows, 'offset': offset, 'path': part})
+        print(f'Exported {rows} rows of subject {subject_id}')
+
+    for batch in db.iter_all(table, itersize, columnar=True, order_by='subject_id'):
+        # a batch may span several subjects, split it on the subject boundaries
+        subjects = batch['subject_id']
+        bounds = np.flatnonzero(np.diff(subjects)) + 1
+        for part in np.split(np.arange(len(subjects)), bounds):
+            part_subject = int(subjects[part[0]])
+            if subject_id is not None and part_subject != subject_id:
+                write_part()
+                pending = {}
+            subject_id = part_subject
+            for name, column in batch.items():
+                pending.setdefault(name, []).append(column[part])
+
+    if pending:
+        write_part()
+
+    manifest['rows'] = sum(shard['rows'] for shard in manifest['shards'])
+    for name in pending:
+        manifest['columns'][name] = merge_parts(folder, name, manifest['shards'])
+    for shard in manifest['shards']:
+        shutil.rmtree(shard.pop('path'))
+    os.rmdir(os.path.join(folder, PARTS))
+
+    with open(os.path.join(folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Exported {manifest['rows']} rows in {time.perf_counter() - start} seconds")
+    return manifest
+
+
+def merge_parts(folder, name, shards) -> dict:
+    """
+    Write the parts of column name exported per subject into a single .npy file, one part at a time.
+    Text widths are widened to the widest part, parts holding only NULLs take the dtype of the others,
+    any other disagreement between the parts fails the export.
+    """
+    parts = []
+    for shard in shards:
+        array = np.load(os.path.join(shard['path'], f'{name}.npy'), mmap_mode='r')
+        valid_path = os.path.join(shard['path'], f'{name}.valid.npy')
+        valid = np.load(valid_path) if os.path.exists(valid_path) else None
+        parts.append((array, valid))
+
+    typed = [array for array, valid in parts if valid is None or valid.any()]
+    dtype, shape = (typed[0].dtype, typed[0].shape[1:]) if typed else (np.dtype(np.int64), ())
+    for array in typed[1:]:
+        if array.shape[1:] != shape:
+            raise ValueError(f'Column {name} has shape {array.shape[1:]} in one subject and {shape} in another')
+        if array.dtype != dtype:
+            if array.dtype.kind != 'U' or dtype.kind != 'U':
+                raise ValueError(f'Column {name} has dtype {array.dtype} in one subject and {dtype} in another')
+            dtype = np.promote_types(dtype, array.dtype)
+
+    rows = sum(shard['rows'] for shard in shards)
+    out = np.lib.format.open_memmap(os.path.join(folder, f'{name}.npy'), 'w+', dtype, (rows, *shape))
+    nullable = any(valid is not None for array, valid in parts)
+    out_valid = np.lib.format.open_memmap(os.path.join(folder, f'{name}.valid.npy'), 'w+', bool, (rows,)) if nullable else None
+
+    for shard, (array, valid) in zip(shards, parts):
+        rows = slice(shard['offset'], shard['offset'] + shard['rows'])
+        if valid is not None and not valid.any():
+            out[rows] = null_value(dtype)
+        else:
+            out[rows] = array
+        if nullable:
+            out_valid[rows] = True if valid is None else valid
+
+    out.flush()
+    if nullable:
+        out_valid.flush()
+    return {'dtype': dtype.str, 'shape': list(shape), 'nullable': nullable}
+
+
+def narrow(name, array: np.ndarray, valid: np.ndarray = None) -> np.ndarray:
+    """
+    Narrow numeric column name to its dtype in DTYPES, failing if a value does not fit.
+    NULLs, flagged False in valid, are stored as null_value of the narrowed dtype.
+    """
+    dtype = np.dtype(DTYPES.get(name, array.dtype))
+    if array.dtype == dtype or array.dtype.kind not in 'iuf':
+        return array
+
+    values = array if valid is None else array[valid]
+    if dtype.kind in 'iu' and values.size:
+        info = np.iinfo(dtype)
+        if values.min() < info.min or values.max() > info.max:
+            raise ValueError(f'Column {name} holds values outside the range of {dtype}')
+
+    narrowed = array.astype(dtype)
+    if valid is not None:
+        narrowed[~valid] = null_value(dtype)
+    return narrowed
+
+
+def null_value(dtype: np.dtype):
+    """
+    The value NULLs are stored as in a column of dtype.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind == 'i':
+        return np.iinfo(dtype).min
+    if dtype.kind == 'U':
+        return ''
+    return np.zeros((), dtype)
+
+
+def column_values(column: np.ndarray) -> typing.Tuple[np.ndarray, typing.Optional[np.ndarray]]:
+    """
+    Convert a column fetched from the database to a fixed-width dtype, see column_array.
+    NULLs are stored as null_value of that dtype, and flagged False in the returned validity mask,
+    which is None if the column holds no NULLs. A column of only NULLs becomes NULL_INT.
+    """
+    if column.dtype != object:
+        return column, None
+
+    valid = np.fromiter((value is not None for value in column), dtype=bool, count=len(column))
+    if valid.all():
+        return column_array(column), None
+    if not valid.any():
+        return np.full(len(column), NULL_INT), valid
+
+    values = column_array(column[valid])
+    array = np.full((len(column), *values.shape[1:]), null_value(values.dtype), dtype=values.dtype)
+    array[valid] = values
+    return array, valid
+
+
+def column_array(column: np.ndarray) -> np.ndarray:
+    """
+    Convert a column fetched from the database, without NULLs, to a fixed-width dtype.
+    Times become int64 microseconds since midnight, arrays a 2-D array and text fixed-width unicode.
+    """
+    if column.dtype != object:
+        return column
+    if not len(column):
+        return column.astype(str)
+
+    first = column[0]
+    if isinstance(first, datetime.time):
+        return np.array([((t.hour * 60 + t.minute) * 60 + t.second) * 10**6 + t.microsecond for t in column], dtype=np.int64)
+    if isinstance(first, (list, tuple, np.ndarray)):
+        array = np.array([np.hstack(value) for value in column])
+        return array.astype(np.uint8) if array.min() >= 0 and array.max() <= 255 else array
+    if isinstance(first, bool):
+        return column.astype(bool)
+    if isinstance(first, int):
+        return column.astype(np.int64)
+    if isinstance(first, (float, decimal.Decimal)):
+        return column.astype(np.float64)
+    return column.astype(str)
+
+
+def load_manifest(folder) -> dict:
+    with open(os.path.join(folder, MANIFEST)) as f:
+        return json.load(f)
+
+
+def load_columns(folder, columns=None, mmap_mode='r') -> typing.Dict[str, np.ndarray]:
+    """
+    Load the columns of an export as one array each, memory mapped unless mmap_mode is None,
+    so processes reading the same export share it through the page cache.
+    """
+    manifest = load_manifest(folder)
+    columns = columns or list(manifest['columns'])
+    return {name: np.load(os.path.join(folder, f'{name}.npy'), mmap_mode=mmap_mode) for name in columns}
+
+
+def load_valid(folder, columns=None, mmap_mode='r') -> typing.Dict[str, np.ndarray]:
+    """
+    Load the validity masks of the columns of an export holding NULLs, see column_values.
+    """
+    manifest = load_manifest(folder)
+    columns = columns or list(manifest['columns'])
+    return {name: np.load(os.path.join(folder, f'{name}.valid.npy'), mmap_mode=mmap_mode)
+            for name in columns if manifest['columns'][name]['nullable']}
+
+
+def load_shards(folder, columns=None, mmap_mode='r') -> typing.List[typing.Dict[str, np.ndarray]]:
+    """
+    Load the columns of every subject of an export, as slices of the memory mapped columns.
+    """
+    manifest = load_manifest(folder)
+    loaded = load_columns(folder, columns, mmap_mode)
+    return [{name: column[shard['offset']:shard['offset'] + shard['rows']] for name, column in loaded.items()}
+            for shard in manifest['shards']]
+
+
+if __name__ == "__main__":
+    export_training(sys.argv[1] if len(sys.argv) > 1 else 'export')
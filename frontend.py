@@ -10,6 +10,8 @@ import csv
 import uuid
 import math
 import database as db
+from jobs import jobs
+from ingest import store_repetition, refresh_training
 import sys
 
 frontend = Blueprint('frontend', __name__)
@@ -78,18 +80,35 @@ def calibrate(user_id, step):
 
     if form.validate_on_submit():
 
-        # construct calibration tuple
-        calibration_values, calibration_iterations = data
-        calibration = {
-            'subject_id': user_id,
-            'calibration_gesture': gesture.split('/')[-1].replace('_', ' ').split('.')[0].strip(),
-            'calibration_values': calibration_values,
-            'calibration_iterations': calibration_iterations
-        }
+        if isinstance(data, dict):
+            # every device was calibrated at once, store them under their own gesture
+            calibrations = []
+            for device_name, (calibration_values, calibration_iterations) in data.items():
+                device_gesture = next((url for url in calibration_image_urls
+                                       if url.split('/')[-1].startswith(device_name)), device_name)
+                calibrations.append({
+                    'subject_id': user_id,
+                    'calibration_gesture': device_gesture.split('/')[-1].replace('_', ' ').split('.')[0].strip(),
+                    'calibration_values': calibration_values,
+                    'calibration_iterations': calibration_iterations
+                })
+            # only skip the remaining steps once every configured device is calibrated
+            configured = app.config.get('BIOX_DEVICES', {}).keys()
+            if all(name in data for name in configured):
+                step = len(calibration_image_urls) - 1
+        else:
+            # construct calibration tuple
+            calibration_values, calibration_iterations = data
+            calibrations = [{
+                'subject_id': user_id,
+                'calibration_gesture': gesture.split('/')[-1].replace('_', ' ').split('.')[0].strip(),
+                'calibration_values': calibration_values,
+                'calibration_iterations': calibration_iterations
+            }]
 
         # attempt to insert into database
         try:
-            db.insert_calibration(calibration)
+            db.insert_calibrations(calibrations)
         except Exception as identifier:
             sys.stderr.write(repr(identifier))
             flash(
@@ -104,7 +123,8 @@ def calibrate(user_id, step):
     gesture = form.image.data.split('/')[-1].split('.')[0]
     form.data.data = None
     status_text = f'Calibration: {int(step % len(calibration_image_urls)) + 1} / {len(calibration_image_urls)}'
-    return render_template('calibrate.html', form=form, status=status_text, gesture=gesture)
+    return render_template('calibrate.html', form=form, status=status_text, gesture=gesture,
+                           concurrent=app.config.get('CONCURRENT_CALIBRATION', False))
 
 
 @frontend.route('/test/<int:user_id>/<int:step>', methods=('GET', 'POST'))
@@ -122,45 +142,45 @@ def test(user_id, step, reps=5):
     tests_per_rep = int(len(test_image_urls) / reps)
     rep = math.ceil((step + 1) / tests_per_rep)
 
-    # remove data with matching id, cal_id && gesture from database
-    db.clear_existing_data({
-        'subject_id': user_id,
-        'gesture': gesture,
-        'repetition': rep})
-
     if form.validate_on_submit():
-        rows = []
-        # insert data into database
-        for count, item in enumerate(data):
-            reading, timestamp = item
-            timestamp = time.strftime("%H:%M:%S.{}".format(
-                str(timestamp).split('.')[-1]), time.localtime(timestamp))
-
-            rows.append({
-                'subject_id': user_id,
-                'gesture': gesture,
-                'repetition': rep,
-                'reading_count': count,
-                'readings': reading,
-                'timestamp': timestamp
-            })
-        try:
-            db.insert_data_repetition(rows)
-        except Exception as identifier:
-            sys.stderr.write(repr(identifier))
-            flash(
-                'Could not insert into database, please try again.', 'danger')
+        job_id = form.identifier.data
+        if job_id:
+            # the data was collected and inserted by a collection job
+            job = jobs.get(job_id)
+            if job is None or job.state != 'done':
+                flash(
+                    'Could not insert into database, please try again.', 'danger')
+        else:
+            # replace data with matching id && gesture in database
+            rows = db.data_rows(user_id, gesture, rep, data)
+            try:
+                store_repetition({
+                    'subject_id': user_id,
+                    'gesture': gesture,
+                    'repetition': rep}, rows)
+            except Exception as identifier:
+                sys.stderr.write(repr(identifier))
+                flash(
+                    'Could not insert into database, please try again.', 'danger')
 
         if step == len(test_image_urls) - 1:
+            # the subject is complete, add it to the training dataset once its data is written
+            try:
+                refresh_training(user_id)
+            except Exception as identifier:
+                sys.stderr.write(repr(identifier))
             return redirect(url_for('.done'))
         else:
             return redirect(url_for('.test', user_id=user_id, step=step + 1))
 
     form.image.data = test_image_urls[step]
     form.data.data = None
+    form.identifier.data = None
+    gesture = form.image.data.split(
+        '/')[-1].replace('_', ' ').split('.')[0].strip()
     status_text = f'''Test: {int(step % tests_per_rep) + 1} / {tests_per_rep}
         Rep: {rep} / {reps}'''
-    return render_template('test.html', form=form, status=status_text)
+    return render_template('test.html', form=form, status=status_text, user_id=user_id, gesture=gesture, rep=rep)
 
 
 def get_gesture_sequence(rep=10, seed=42):
@@ -0,0 +1,207 @@
+import json
+import os
+import queue
+import threading
+import time
+import typing
+import psycopg2
+import psycopg2.pool
+from flask import current_app
+import database as db
+
+# Errors after which writing the same repetition again may succeed
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError)
+
+
+class DeadLetters():
+    """
+    Append-only file of the repetitions that could not be written to the database,
+    one JSON record per line along with the error, for inspection and manual replay.
+    """
+
+    def __init__(self, path='dead_letters.jsonl'):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def append(self, metadata: dict, rows: list, error: Exception) -> None:
+        record = json.dumps({'metadata': metadata, 'rows': rows, 'error': repr(error),
+                             'time': time.time()}, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(record + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.count += 1
+        print(f'Moved repetition {metadata} to {self.path} ({error})')
+
+
+def write_each(batch: list, dead_letters: DeadLetters) -> typing.Tuple[list, int]:
+    """
+    Write the (metadata, rows) repetitions of batch one at a time, moving those failing
+    with anything but a transient error to dead_letters.
+    Returns the repetitions that failed with a transient error, and the number moved to dead_letters.
+    """
+    remaining = []
+    dead = 0
+    for metadata, rows in batch:
+        try:
+            db.replace_repetition(metadata, rows)
+        except TRANSIENT_ERRORS:
+            remaining.append((metadata, rows))
+        except Exception as error:
+            dead_letters.append(metadata, rows, error)
+            dead += 1
+    return remaining, dead
+
+
+class IngestWorker(threading.Thread):
+    """
+    Background thread writing queued repetitions to the database.
+    Repetitions queued within commit_interval seconds of each other, up to max_batch,
+    are written in a single transaction. Once maxsize repetitions are waiting,
+    submit blocks, pushing back on the requests producing them.
+    A batch failing max_attempts times is written one repetition at a time,
+    and the repetitions that cannot be written at all are moved to dead_letters.
+    """
+
+    def __init__(self, app, maxsize=100, commit_interval=.5, max_batch=50, max_backoff=60.,
+                 max_attempts=3, dead_letters: DeadLetters = None):
+        super().__init__(daemon=True)
+        self.app = app
+        self.queue = queue.Queue(maxsize)
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters or DeadLetters()
+
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.last_flush_latency = 0.
+        self.max_flush_latency = 0.
+        self.total_flush_latency = 0.
+
+    def submit(self, metadata: dict, rows: list, timeout: float = None) -> None:
+        """
+        Queue a repetition for writing, blocking up to timeout seconds while the queue is full.
+        Raises queue.Full if it is still full after that.
+        Rows of None queue a refresh of the training dataset for the subject instead, see refresh_training.
+        """
+        self.queue.put((metadata, rows), timeout=timeout)
+
+    def run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.commit_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            repetitions = [record for record in batch if record[1] is not None]
+            if repetitions:
+                self.flush(repetitions)
+            # every repetition queued before a refresh was flushed along with this batch
+            with self.app.app_context():
+                refresh_subjects([metadata['subject_id'] for metadata, rows in batch if rows is None])
+            for _ in batch:
+                self.queue.task_done()
+
+    def flush(self, batch: list) -> None:
+        """
+        Write batch in one transaction, retrying with exponential backoff.
+        After max_attempts failures the repetitions are written one at a time instead,
+        retrying only those failing with a transient error.
+        """
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                with self.app.app_context():
+                    if attempt < self.max_attempts:
+                        db.replace_repetitions(batch)
+                        written = len(batch)
+                    else:
+                        remaining, dead = write_each(batch, self.dead_letters)
+                        self.flushed += len(batch) - len(remaining) - dead
+                        batch = remaining
+                        if batch:
+                            raise ConnectionError(f'{len(batch)} repetition(s) could not be written')
+                        written = 0
+            except Exception as error:
+                self.failures += 1
+                attempt += 1
+                backoff = min(self.commit_interval * 2 ** attempt, self.max_backoff)
+                print(f'Ingest of {len(batch)} repetition(s) failed ({error}), retrying in {backoff} seconds')
+                time.sleep(backoff)
+            else:
+                latency = time.perf_counter() - start
+                self.flushes += 1
+                self.flushed += written
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self.total_flush_latency += latency
+                return
+
+    def metrics(self) -> dict:
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'failures': self.failures,
+            'dead_letters': self.dead_letters.count,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'mean_flush_latency': self.total_flush_latency / self.flushes if self.flushes else 0.,
+        }
+
+
+def store_repetition(metadata: dict, rows: list) -> None:
+    """
+    Store a repetition through the spool of the current app if it has one,
+    else through its ingest worker if it has one, otherwise write it to the database directly.
+    """
+    spool = current_app.extensions.get('spool')
+    worker: IngestWorker = current_app.extensions.get('ingest')
+
+    if spool is not None:
+        spool.append(metadata, rows)
+    elif worker is not None:
+        worker.submit(metadata, rows, current_app.config.get('INGEST_TIMEOUT', 30))
+    else:
+        db.replace_repetition(metadata, rows)
+
+
+def refresh_training(subject_id) -> None:
+    """
+    Refresh the training dataset for subject_id once every repetition stored before
+    through store_repetition has reached the database.
+    """
+    spool = current_app.extensions.get('spool')
+    worker: IngestWorker = current_app.extensions.get('ingest')
+    marker = {'subject_id': subject_id}
+
+    if spool is not None:
+        spool.append(marker, None)
+    elif worker is not None:
+        worker.submit(marker, None, current_app.config.get('INGEST_TIMEOUT', 30))
+    else:
+        refresh_subjects([subject_id])
+
+
+def refresh_subjects(subject_ids: typing.List[int]) -> None:
+    """
+    Refresh the training dataset for every subject in subject_ids, logging failures.
+    """
+    for subject_id in dict.fromkeys(subject_ids):
+        try:
+            db.refresh_training(subject_id)
+        except Exception as error:
+            print(f'Refreshing the training dataset for subject {subject_id} failed ({error})')
@@ -0,0 +1,105 @@
+import threading
+import time
+import typing
+import uuid
+
+
+class Job():
+    """
+    A unit of work running on a background thread.
+    Every update bumps the version, so observers can wait for the next change.
+    """
+
+    def __init__(self, target: typing.Callable[['Job'], typing.Any]):
+        self.id = uuid.uuid4().hex
+        self.target = target
+        self.state = 'pending'
+        self.progress = 0.
+        self.preview = None
+        self.error = None
+        self.result = None
+        self.version = 0
+        self.finished_at = None
+        self._changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.state in ('done', 'failed')
+
+    def update(self, **kwargs) -> None:
+        """
+        Update the given attributes and wake up observers.
+        """
+        with self._changed:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait(self, version: int, timeout: float = None) -> dict:
+        """
+        Wait until the job changes past version, or timeout seconds passed.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.version > version or self.done, timeout)
+            return self.status()
+
+    def status(self) -> dict:
+        return {
+            'id': self.id,
+            'state': self.state,
+            'progress': self.progress,
+            'preview': self.preview,
+            'error': self.error,
+            'version': self.version,
+        }
+
+    def run(self) -> None:
+        """
+        Body of the thread started by JobManager.submit.
+        """
+        self.update(state='running')
+        try:
+            result = self.target(self)
+        except Exception as error:
+            self.update(state='failed', error=str(error),
+                        finished_at=time.monotonic())
+        else:
+            self.update(state='done', progress=1., result=result,
+                        finished_at=time.monotonic())
+
+
+class JobManager():
+    """
+    Starts jobs and keeps finished ones around for keep seconds.
+    """
+
+    def __init__(self, keep=600.):
+        self.keep = keep
+        self.jobs: typing.Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, target: typing.Callable[[Job], typing.Any]) -> Job:
+        """
+        Run target on a new thread, passing it the job to report progress on.
+        """
+        job = Job(target)
+        with self._lock:
+            self._expire()
+            self.jobs[job.id] = job
+        threading.Thread(target=job.run, daemon=True).start()
+        return job
+
+    def get(self, job_id) -> typing.Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for job_id in [job.id for job in self.jobs.values()
+                       if job.done and now - job.finished_at > self.keep]:
+            del self.jobs[job_id]
+
+
+jobs = JobManager()
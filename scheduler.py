@@ -0,0 +1,89 @@
+import time
+import typing
+import numpy as np
+
+
+class JitterStats(typing.NamedTuple):
+    samples: int
+    rate: float
+    p50: float
+    p99: float
+    overruns: int
+
+
+class Scheduler():
+    """
+    Runs a task at a fixed rate against absolute deadlines.
+    The time until a deadline is slept away, except for the last spin seconds
+    which are busy-waited to keep the wake-up precise. Unless spin is given, it is derived
+    from how late sleeps typically wake up, at least min_spin and at most half a period,
+    so the busy-wait takes as little CPU as the sleep precision allows.
+    """
+
+    def __init__(self, rate=1000., spin=None, min_spin=.00005):
+        self.rate = rate
+        self.period = 1. / rate
+        self.spin = spin
+        self.min_spin = min_spin
+        # Running average of how late sleeps woke up
+        self.oversleep = min_spin
+
+    def run(self, task: typing.Callable[[float], typing.Any], duration: float) -> typing.Tuple[list, JitterStats]:
+        """
+        Call task with its start time once per period for duration seconds.
+        Returns the results along with the jitter statistics of the run.
+        """
+        results = []
+        starts = []
+        overruns = 0
+
+        t_start = time.perf_counter()
+        t_end = t_start + duration
+        deadline = t_start
+
+        while deadline < t_end:
+            t_curr = time.perf_counter()
+            starts.append(t_curr)
+            results.append(task(t_curr))
+
+            deadline += self.period
+            now = time.perf_counter()
+            if now > deadline:
+                # Skip the periods missed rather than bursting to catch up
+                missed = int((now - deadline) // self.period) + 1
+                overruns += missed
+                deadline += missed * self.period
+            self.wait(deadline)
+
+        return results, self.stats(starts, overruns)
+
+    def wait(self, deadline: float) -> None:
+        """
+        Sleep until shortly before deadline, then spin until it is reached.
+        """
+        spin = self.spin if self.spin is not None else \
+            min(max(self.oversleep * 1.5, self.min_spin), self.period / 2)
+        now = time.perf_counter()
+        if deadline - now > spin:
+            wake = deadline - spin
+            time.sleep(wake - now)
+            self.oversleep += .05 * (time.perf_counter() - wake - self.oversleep)
+        while time.perf_counter() < deadline:
+            pass
+
+    @staticmethod
+    def stats(starts: typing.List[float], overruns: int = 0) -> JitterStats:
+        """
+        Summarize the start times of a run.
+        """
+        if len(starts) < 2:
+            return JitterStats(len(starts), 0., 0., 0., overruns)
+
+        intervals = np.diff(starts)
+        return JitterStats(
+            samples=len(starts),
+            rate=(len(starts) - 1) / (starts[-1] - starts[0]),
+            p50=float(np.percentile(intervals, 50)),
+            p99=float(np.percentile(intervals, 99)),
+            overruns=overruns,
+        )
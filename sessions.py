@@ -0,0 +1,141 @@
+import atexit
+import threading
+import time
+import typing
+from contextlib import contextmanager
+from serial.serialutil import SerialException
+from biox import BIOX
+
+
+class Session():
+    """
+    A connection to a single BIOX device that outlives the request using it.
+    """
+
+    def __init__(self, serial_number, port, sensors=8):
+        self.serial_number = serial_number
+        self.port = port
+        self.sensors = sensors
+        self.device: BIOX = None
+        self.last_used = 0.
+        self.lock = threading.Lock()
+
+    def checkout(self, probe_after: float) -> BIOX:
+        """
+        Return an open device, reconnecting if the current one is gone.
+        Devices idle for longer than probe_after seconds are probed first.
+        """
+        if self.device is not None and self.device.port != self.port:
+            self.discard()
+
+        if self.device is not None and time.perf_counter() - self.last_used > probe_after:
+            if not self.probe():
+                self.discard()
+
+        if self.device is None:
+            self.device = BIOX(self.port, sensors=self.sensors)
+        else:
+            self.device.flush()
+
+        return self.device
+
+    def checkin(self) -> None:
+        """
+        Hand the device back after use.
+        """
+        self.last_used = time.perf_counter()
+        if self.device is not None:
+            self.device.stop_stream()
+
+    def probe(self, timeout=.1) -> bool:
+        """
+        Check the device still answers the connect handshake.
+        """
+        timeout, self.device.timeout = self.device.timeout, timeout
+        try:
+            self.device.flush()
+            self.device.connect()
+        except (IOError, SerialException):
+            return False
+        finally:
+            if self.device.is_open:
+                self.device.timeout = timeout
+        return True
+
+    def discard(self) -> None:
+        """
+        Close the device, the next checkout opens a new connection.
+        """
+        device, self.device = self.device, None
+        if device is not None:
+            try:
+                device.close()
+            except (IOError, SerialException):
+                pass
+
+
+class BIOXPool():
+    """
+    Keeps BIOX devices connected across requests, keyed by serial number.
+    """
+
+    def __init__(self, probe_after=5.):
+        self.probe_after = probe_after
+        self.sessions: typing.Dict[str, Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, serial_number, port, sensors=8) -> Session:
+        """
+        Get the session of the device with serial number, creating it if needed.
+        """
+        with self._lock:
+            session = self.sessions.get(serial_number)
+            if session is None:
+                session = self.sessions[serial_number] = Session(
+                    serial_number, port, sensors)
+            return session
+
+    @contextmanager
+    def lease(self, serial_number, port, sensors=8, timeout=-1) -> typing.Iterator[BIOX]:
+        """
+        Lease the device with serial number for the duration of the block.
+        The device is reconnected if it fails the health probe, and discarded if
+        the block raises a SerialException so the next lease reconnects it.
+        """
+        session = self.session(serial_number, port, sensors)
+
+        if not session.lock.acquire(timeout=timeout):
+            raise TimeoutError(f'BIOX device {serial_number} is in use')
+
+        try:
+            session.port, session.sensors = port, sensors
+            try:
+                device = session.checkout(self.probe_after)
+            except SerialException:
+                # The port may have been reopened under the same name, retry once
+                session.discard()
+                device = session.checkout(self.probe_after)
+
+            try:
+                yield device
+            except SerialException:
+                session.discard()
+                raise
+            finally:
+                session.checkin()
+        finally:
+            session.lock.release()
+
+    def close(self) -> None:
+        """
+        Disconnect and close every device in the pool.
+        """
+        with self._lock:
+            for session in self.sessions.values():
+                with session.lock:
+                    session.discard()
+            self.sessions.clear()
+
+
+pool = BIOXPool()
+atexit.register(pool.close)
@@ -0,0 +1,166 @@
+import os
+import pty
+import tty
+import select
+import threading
+import time
+import numpy as np
+from serial.tools.list_ports_common import ListPortInfo
+
+FRAME_SIZE = 8
+
+
+class VirtualBIOX():
+    """
+    Simulated BIOX device served over a pseudo-terminal.
+    Answers 'C' with 'A', 'S' with an 8 byte frame, shifts the sensors resting
+    values on 'I', 'i' and 'R' and goes passive on 'D', like the armband does.
+    """
+
+    def __init__(self, serial_number, sensors=8, latency=0., noise=2., resting=(40, 80),
+                 step=1, saturation=255, drop_rate=0., fail_after=None, seed=None):
+        self.serial_number = serial_number
+        self.sensors = sensors
+        # Seconds to wait before answering a request
+        self.latency = latency
+        # Standard deviation of the gaussian noise added to every sample
+        self.noise = noise
+        # Value every sample saturates at
+        self.saturation = saturation
+        # Resting value change per calibration step
+        self.step = step
+        # Probability of a sample request going unanswered
+        self.drop_rate = drop_rate
+        # Number of frames after which the device disappears
+        self.fail_after = fail_after
+
+        self.random = np.random.RandomState(seed)
+        self.resting = self.random.randint(*resting, size=sensors)
+        self.offset = 0
+        self.connected = False
+        self.frames_sent = 0
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._running = threading.Event()
+        self._thread: threading.Thread = None
+
+    def __enter__(self) -> 'VirtualBIOX':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> 'VirtualBIOX':
+        """
+        Open the pseudo-terminal and start answering requests on it.
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running.set()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop answering requests and close the pseudo-terminal.
+        """
+        if not self._running.is_set():
+            return
+
+        self._running.clear()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def port_info(self) -> ListPortInfo:
+        """
+        Describe the simulator the way list_ports does a real device.
+        """
+        info = ListPortInfo(self.port)
+        info.serial_number = self.serial_number
+        info.description = f'Virtual BIOX {self.serial_number}'
+        return info
+
+    def sample(self) -> bytes:
+        """
+        Produce a single frame from the current resting values.
+        """
+        values = self.resting + self.offset * self.step + \
+            self.random.normal(0, self.noise, self.sensors)
+        frame = np.zeros(FRAME_SIZE, dtype=np.uint8)
+        frame[:self.sensors] = np.clip(np.rint(values), 0, self.saturation)
+        return frame.tobytes()
+
+    def handle(self, command: int) -> bytes:
+        """
+        Apply a single command byte and return the answer, if any.
+        """
+        command = chr(command)
+
+        if command == 'C':
+            self.connected = True
+            return b'A'
+        if not self.connected:
+            return b''
+
+        if command == 'S':
+            if self.random.random_sample() < self.drop_rate:
+                return b''
+            self.frames_sent += 1
+            return self.sample()
+        elif command == 'I':
+            self.offset += 1
+        elif command == 'i':
+            self.offset -= 1
+        elif command == 'R':
+            self.offset = 0
+        elif command == 'D':
+            self.connected = False
+        return b''
+
+    def _serve(self) -> None:
+        """
+        Body of the thread started by start.
+        """
+        while self._running.is_set():
+            readable, _, _ = select.select([self._master], [], [], .05)
+            if not readable:
+                continue
+
+            try:
+                commands = os.read(self._master, 1024)
+            except OSError:
+                continue
+
+            if self.latency:
+                time.sleep(self.latency)
+
+            answer = b''.join(self.handle(command) for command in commands)
+
+            if self.fail_after is not None and self.frames_sent > self.fail_after:
+                # Simulate the device being unplugged
+                self._running.clear()
+                os.close(self._slave)
+                os.close(self._master)
+                return
+
+            if answer:
+                os.write(self._master, answer)
+
+
+if __name__ == "__main__":
+    devices = [VirtualBIOX('VIRTUAL_ARM', sensors=8).start(),
+               VirtualBIOX('VIRTUAL_WRIST', sensors=7).start()]
+    print("BIOX_DEVICES = {")
+    for name, device in zip(['arm', 'wrist'], devices):
+        print(f"    '{name}': {{'serial_number': '{device.serial_number}', 'num_sensors': {device.sensors}, 'port': '{device.port}'}},")
+    print("}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        [device.stop() for device in devices]
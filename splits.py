@@ -0,0 +1,95 @@
+import hashlib
+import typing
+import numpy as np
+
+
+def _md5(text) -> int:
+    return int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+
+
+def _key_text(subject_id, repetition=None, seed=0) -> str:
+    if repetition is None:
+        return f'{seed}:{subject_id}'
+    return f'{seed}:{subject_id}:{repetition}'
+
+
+def hash_key(subject_id, repetition=None, seed=0) -> np.ndarray:
+    """
+    Hash whole subjects, or whole repetitions of subjects, to uint32 values
+    taken from the first 32 bits of the md5 of the key, like hash_key_sql does.
+    Only the distinct keys are hashed.
+    """
+    keys = np.asarray(subject_id, dtype=np.int64)
+    if repetition is not None:
+        keys = np.stack((keys, np.asarray(repetition, dtype=np.int64)), axis=-1)
+        unique, inverse = np.unique(keys.reshape(-1, 2), axis=0, return_inverse=True)
+        hashes = [_md5(_key_text(s, r, seed)) for s, r in unique.tolist()]
+    else:
+        unique, inverse = np.unique(keys.reshape(-1), return_inverse=True)
+        hashes = [_md5(_key_text(s, seed=seed)) for s in unique.tolist()]
+    return np.array(hashes, dtype=np.uint64)[inverse.reshape(-1)].reshape(np.shape(subject_id))
+
+
+def hash_key_sql(by='subject', seed=0) -> str:
+    """
+    The SQL expression computing hash_key over the subject_id and repetition columns.
+    """
+    key = "subject_id" if by == 'subject' else "subject_id || ':' || repetition"
+    return f"('x' || substr(md5('{int(seed)}:' || {key}), 1, 8))::bit(32)::bigint"
+
+
+def assign_folds(features: dict, folds: int, by='subject', seed=0) -> np.ndarray:
+    """
+    Assign every example to one of folds folds, keeping whole subjects
+    (by='subject') or whole repetitions (by='repetition') together.
+    """
+    repetition = features['repetition'] if by == 'repetition' else None
+    return (hash_key(features['subject_id'], repetition, seed) % np.uint64(folds)).astype(np.int64)
+
+
+def fold_where(fold: int, folds: int, by='subject', seed=0) -> str:
+    """
+    SQL condition selecting the rows assign_folds puts in fold, for use with database.get_where.
+    """
+    return f'mod({hash_key_sql(by, seed)}, {int(folds)}) = {int(fold)}'
+
+
+def holdout(features: dict, test_fraction=.2, by='subject', seed=0) -> np.ndarray:
+    """
+    Mask of the examples held out for testing: the round(test_fraction * n) of the
+    n subjects or repetitions with the lowest hashes, at least one if test_fraction > 0.
+    """
+    repetition = features['repetition'] if by == 'repetition' else None
+    hashes = hash_key(features['subject_id'], repetition, seed)
+    unique = np.unique(hashes)
+    held_out = round(test_fraction * len(unique))
+    if test_fraction > 0 and len(unique) > 1:
+        held_out = min(max(held_out, 1), len(unique) - 1)
+    return np.isin(hashes, unique[:held_out])
+
+
+def k_fold(features: dict, k=5, by='subject', seed=0) -> typing.Iterator[typing.Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield (train, test) index arrays for each of k folds, assigning the folds in a single pass.
+    """
+    folds = assign_folds(features, k, by, seed)
+    order = np.argsort(folds, kind='stable')
+    bounds = np.searchsorted(folds[order], np.arange(k + 1))
+    for fold in range(k):
+        test = order[bounds[fold]:bounds[fold + 1]]
+        train = np.concatenate((order[:bounds[fold]], order[bounds[fold + 1]:]))
+        yield train, test
+
+
+def leave_one_subject_out(features: dict) -> typing.Iterator[typing.Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Yield (subject_id, train, test) index arrays holding out each subject in turn,
+    grouping the examples by subject in a single pass.
+    """
+    subjects, inverse = np.unique(features['subject_id'], return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(subjects) + 1))
+    for i, subject_id in enumerate(subjects.tolist()):
+        test = order[bounds[i]:bounds[i + 1]]
+        train = np.concatenate((order[:bounds[i]], order[bounds[i + 1]:]))
+        yield subject_id, train, test
@@ -0,0 +1,240 @@
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+import typing
+import zlib
+import database as db
+import ingest
+
+MAGIC = b'XSPL'
+# magic, payload length, crc32 of payload
+HEADER = struct.Struct('>4sII')
+
+
+class Spool():
+    """
+    Durable append-only log of collected repetitions, kept in segment files in folder.
+    Every record is fsynced before append returns and carries a checksum, so a record
+    torn by a crash is detected and skipped on replay.
+    Several processes may share folder: each appends to segments of its own, holding an
+    exclusive flock on the one it is writing, so only unlocked segments are replayed.
+    """
+
+    def __init__(self, folder='spool', segment_size=64 * 1024 * 1024):
+        self.folder = folder
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._active = None
+        self.appended = threading.Event()
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        elif not os.path.isdir(folder):
+            raise FileExistsError()
+
+    def segments(self) -> typing.List[str]:
+        """
+        Get the names of the segment files, oldest first.
+        """
+        return sorted(name for name in os.listdir(self.folder) if name.endswith('.seg'))
+
+    def append(self, metadata: dict, rows: list) -> None:
+        """
+        Durably write a repetition to the active segment.
+        Rows of None record a refresh of the training dataset for the subject instead.
+        """
+        payload = json.dumps({'metadata': metadata, 'rows': rows}, default=str).encode()
+
+        with self._lock:
+            if self._active is None:
+                self._active = self._open_segment()
+
+            self._active.write(HEADER.pack(MAGIC, len(payload), zlib.crc32(payload)) + payload)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+
+            if self._active.tell() >= self.segment_size:
+                self._seal()
+
+        self.appended.set()
+
+    def _open_segment(self) -> typing.BinaryIO:
+        """
+        Create a new segment, named by creation time and process, and lock it for writing.
+        """
+        while True:
+            name = f'{time.time_ns():020d}-{os.getpid()}.seg'
+            segment = open(os.path.join(self.folder, name), 'xb')
+            fcntl.flock(segment, fcntl.LOCK_EX)
+            # a replayer may have claimed and removed the segment before it was locked
+            if os.fstat(segment.fileno()).st_nlink:
+                return segment
+            segment.close()
+
+    def seal(self) -> None:
+        """
+        Close the active segment, releasing its lock, the next append starts a new one.
+        """
+        with self._lock:
+            self._seal()
+
+    def _seal(self) -> None:
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+    def sealed(self) -> typing.List[str]:
+        """
+        Get the names of the segments this process no longer appends to, oldest first.
+        Segments other processes are appending to are listed as well, see claim.
+        """
+        with self._lock:
+            active = os.path.basename(self._active.name) if self._active else None
+            return [name for name in self.segments() if name != active]
+
+    def claim(self, name) -> typing.Optional[typing.BinaryIO]:
+        """
+        Open segment name and lock it for replaying, or return None if
+        it is being written or replayed by another process, or is gone.
+        The segment stays locked until the returned file is closed.
+        """
+        try:
+            segment = open(os.path.join(self.folder, name), 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            segment.close()
+            return None
+        if not os.fstat(segment.fileno()).st_nlink:
+            segment.close()
+            return None
+        return segment
+
+    def read(self, name, segment: typing.BinaryIO = None) -> typing.Iterator[typing.Tuple[dict, list]]:
+        """
+        Read the (metadata, rows) records of segment name, skipping corrupt ones.
+        Reads from segment if given, e.g. as returned by claim.
+        """
+        if segment is None:
+            with open(os.path.join(self.folder, name), 'rb') as segment:
+                yield from self.read(name, segment)
+            return
+
+        while True:
+            header = segment.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            magic, length, checksum = HEADER.unpack(header)
+            if magic != MAGIC:
+                print(f'Spool segment {name} is corrupt, skipping the rest of it')
+                return
+            payload = segment.read(length)
+            if len(payload) < length:
+                print(f'Spool segment {name} ends in a torn record, skipping it')
+                return
+            if zlib.crc32(payload) != checksum:
+                print(f'Spool segment {name} holds a record with a bad checksum, skipping it')
+                continue
+            record = json.loads(payload.decode())
+            yield record['metadata'], record['rows']
+
+    def remove(self, name) -> None:
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            pass
+
+
+class Replayer(threading.Thread):
+    """
+    Background thread flushing the spooled repetitions to the database in batches,
+    retrying with exponential backoff while the database is unavailable.
+    After max_attempts failed replays the repetitions are written one at a time,
+    and those that cannot be written at all are moved to dead_letters.
+    """
+
+    def __init__(self, spool: Spool, app, interval=1., batch_size=10, max_backoff=60.,
+                 max_attempts=3, dead_letters: 'ingest.DeadLetters' = None):
+        super().__init__(daemon=True)
+        self.spool = spool
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters or ingest.DeadLetters()
+        self.failures = 0
+
+    def run(self) -> None:
+        while True:
+            self.spool.appended.wait(self.interval)
+            self.spool.appended.clear()
+            try:
+                self.replay()
+            except Exception as error:
+                self.failures += 1
+                backoff = min(self.interval * 2 ** self.failures, self.max_backoff)
+                print(f'Spool replay failed ({error}), retrying in {backoff} seconds')
+                time.sleep(backoff)
+            else:
+                self.failures = 0
+
+    def replay(self) -> int:
+        """
+        Flush every spooled repetition to the database, removing segments once flushed.
+        Returns the number of repetitions flushed.
+        """
+        self.spool.seal()
+        flushed = 0
+
+        with self.app.app_context():
+            for name in self.spool.sealed():
+                segment = self.spool.claim(name)
+                if segment is None:
+                    continue
+                with segment:
+                    flushed += self._replay_segment(name, segment)
+                    # replacing is idempotent, so a crash before this point only replays the segment again
+                    self.spool.remove(name)
+
+        return flushed
+
+    def _replay_segment(self, name, segment: typing.BinaryIO) -> int:
+        """
+        Flush the repetitions of a claimed segment, see replay.
+        """
+        flushed = 0
+        batch = []
+        for metadata, rows in self.spool.read(name, segment):
+            if rows is None:
+                # flush the repetitions spooled before refreshing the subject
+                flushed += self.write(batch)
+                batch = []
+                ingest.refresh_subjects([metadata['subject_id']])
+                continue
+            batch.append((metadata, rows))
+            if len(batch) >= self.batch_size:
+                flushed += self.write(batch)
+                batch = []
+        return flushed + self.write(batch)
+
+    def write(self, batch: list) -> int:
+        """
+        Write batch in one transaction, or once replaying failed max_attempts times,
+        one repetition at a time, see ingest.write_each. Returns the number of repetitions written.
+        """
+        if not batch:
+            return 0
+        if self.failures < self.max_attempts:
+            db.replace_repetitions(batch)
+            return len(batch)
+
+        remaining, dead = ingest.write_each(batch, self.dead_letters)
+        if remaining:
+            raise ConnectionError(f'{len(remaining)} repetition(s) could not be written')
+        return len(batch) - dead
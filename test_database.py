@@ -0,0 +1,47 @@
+import contextlib
+import psycopg2.extensions
+import database as db
+
+
+class FakeCursor():
+    """
+    Cursor rendering statements the way psycopg2 would send them, without a server.
+    """
+
+    def __init__(self):
+        self.connection = self
+        self.encoding = 'UTF8'
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return self
+
+    def mogrify(self, sql, args):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        quoted = tuple(psycopg2.extensions.adapt(arg).getquoted().decode() for arg in args)
+        return (sql % quoted).encode()
+
+    def execute(self, sql, args=None):
+        self.executed.append(sql.decode() if isinstance(sql, bytes) else sql)
+
+
+def test_replace_repetition_sends_collected_readings_as_arrays(monkeypatch):
+    cur = FakeCursor()
+    monkeypatch.setattr(db, 'transaction', lambda: contextlib.nullcontext(cur))
+
+    # collect() yields (readings per device, timestamp, device timestamps) per frame
+    data = [(([10 + i] * 8, [20 + i] * 8), .001 * i, [.001 * i, .001 * i]) for i in range(3)]
+    rows = db.data_rows(1, 'fist', 2, data, numeric=True)
+    db.replace_repetition({'subject_id': 1, 'gesture': 'fist', 'repetition': 2}, rows, method='values')
+
+    insert = cur.executed[-1]
+    assert 'INSERT INTO data' in insert
+    assert insert.count('ARRAY[ARRAY[') == len(data)
+    assert 'ARRAY[ARRAY[10,10,10,10,10,10,10,10],ARRAY[20,20,20,20,20,20,20,20]]' in insert
@@ -1,27 +1,164 @@
 import tensorflow as tf
 from tensorflow import feature_column
+import numpy as np
 import database as db
+import export
+import splits
+import time
 import typing
 from typing import List, Tuple
 
+class Split(typing.NamedTuple):
+    features: typing.Dict[str, np.ndarray]
+    labels: typing.Dict[str, np.ndarray]
+
+    @property
+    def count(self) -> int:
+        return len(next(iter(self.labels.values())))
+
+    def take(self, mask) -> 'Split':
+        """
+        Select the examples where mask is True, or at the given indices.
+        """
+        return Split({k:v[mask] for k, v in self.features.items()},
+                     {k:v[mask] for k, v in self.labels.items()})
+
 # A utility method to identify test data
+# Works on single tf examples as well as on whole numpy columns
+# Puts readings of every subject and repetition in both sets, get_data splits with splits.holdout instead
 def is_test(x,y) -> bool:
     return x['reading_count'] % 5 == 0
 # A utility method to identify training data
 def is_training(x,y) -> bool:
     return not is_test(x,y)
 
-def split(dataset, split) -> (tf.data.Dataset, tf.data.Dataset):
-    recover = lambda x,y: y
-    is_a = lambda x,y: x % split != 0
-    is_b = lambda x,y: not is_a(x,y)
-    a_dataset = dataset.enumerate() \
-                        .filter(is_a) \
-                        .map(recover)
-    b_dataset = dataset.enumerate() \
-                        .filter(is_b) \
-                        .map(recover)
-    return a_dataset, b_dataset
+def split(data: Split, split) -> (Split, Split):
+    """
+    Split data into every example but each split'th one, and each split'th one.
+    """
+    is_b = np.arange(data.count) % split == 0
+    return data.take(~is_b), data.take(is_b)
+
+def build_pipeline(data: Split, batch_size, shuffle=True, seed=None, map_func=None) -> tf.data.Dataset:
+    """
+    Build an input pipeline over data with a known cardinality.
+    Examples are mapped in parallel, cached after the first epoch, 
+    shuffled with a buffer the size of the data, batched and prefetched.
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    dataset = tf.data.Dataset.from_tensor_slices((data.features, data.labels))
+    if map_func is not None:
+        dataset = dataset.map(map_func, num_parallel_calls=autotune)
+    dataset = dataset.cache()
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=max(data.count, 1), seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(autotune)
+
+def measure_throughput(dataset: tf.data.Dataset, count: int) -> float:
+    """
+    Iterate a whole epoch of dataset and report the examples per second it delivered.
+    On a cached pipeline this also fills the cache for the epochs that follow.
+    """
+    start = time.perf_counter()
+    for _ in dataset:
+        pass
+    elapsed = time.perf_counter() - start
+    throughput = count / elapsed if elapsed else 0.
+    print(f'Input pipeline delivered {count} examples in {elapsed:.2f} seconds ({throughput:.0f} examples/s)')
+    return throughput
+
+
+class Windows(typing.NamedTuple):
+    readings: np.ndarray
+    starts: np.ndarray
+    context: Split
+    size: int
+
+    @property
+    def count(self) -> int:
+        return len(self.starts)
+
+    def view(self) -> np.ndarray:
+        """
+        Zero-copy view of every window over the ordered readings. Index it with 
+        starts for the windows within a single repetition, which copies them.
+        """
+        return sliding_windows(self.readings, self.size)
+
+def sliding_windows(array: np.ndarray, size) -> np.ndarray:
+    """
+    Zero-copy read-only view of every window of size consecutive rows of array,
+    shaped (len(array) - size + 1, size, ...).
+    """
+    count = max(len(array) - size + 1, 0)
+    return np.lib.stride_tricks.as_strided(
+        array, shape=(count, size, *array.shape[1:]),
+        strides=(array.strides[0], *array.strides), writeable=False)
+
+def make_windows(data: Split, size=100, stride=50, column='readings') -> Windows:
+    """
+    Group the readings by (subject_id, gesture, repetition), order them by reading_count
+    and cut every group into windows of size readings, stride readings apart.
+    Windows are kept as start offsets into the ordered readings rather than copied,
+    the remaining features and labels are taken at the start of each window.
+    """
+    features, labels = data.features, data.labels
+    order = np.lexsort((features['reading_count'], features['repetition'],
+                        labels['label'], features['subject_id']))
+    readings = np.ascontiguousarray(features[column][order])
+
+    keys = (features['subject_id'][order], labels['label'][order], features['repetition'][order])
+    boundaries = np.flatnonzero(np.any([key[1:] != key[:-1] for key in keys], axis=0)) + 1
+    group_starts = np.concatenate(([0], boundaries))
+    group_ends = np.concatenate((boundaries, [len(order)]))
+
+    starts = np.concatenate([np.arange(start, end - size + 1, stride)
+                             for start, end in zip(group_starts, group_ends)] or [np.zeros(0, dtype=np.int64)])
+    starts = starts.astype(np.int64)
+
+    context = Split({k:v for k, v in features.items() if k != column}, labels).take(order[starts])
+    return Windows(readings, starts, context, size)
+
+def build_window_pipeline(windows: Windows, batch_size, shuffle=True, seed=None, column='readings') -> tf.data.Dataset:
+    """
+    Build an input pipeline over windows, slicing each window out of the ordered readings 
+    only as it is fed to the model, so overlapping windows share their readings.
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    readings = tf.constant(windows.readings)
+    size = windows.size
+
+    def attach(start, features, labels):
+        features = dict(features)
+        features[column] = readings[start:start + size]
+        return features, labels
+
+    dataset = tf.data.Dataset.from_tensor_slices((windows.starts, windows.context.features, windows.context.labels))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=max(windows.count, 1), seed=seed, reshuffle_each_iteration=True)
+    return dataset.map(attach, num_parallel_calls=autotune).batch(batch_size).prefetch(autotune)
+
+
+def decode_timestamps(timestamp_ns) -> np.ndarray:
+    """
+    Decode numeric timestamps, in nanoseconds since the start of their repetition, to seconds.
+    """
+    return np.asarray(timestamp_ns, dtype=np.int64) / 10**9
+
+def decode_features(features, labels):
+    """
+    Map function for build_pipeline decoding numeric timestamps to seconds as float32, see decode_timestamps.
+    """
+    if 'timestamp_ns' in features:
+        features = dict(features)
+        features['timestamp_ns'] = tf.cast(tf.cast(features['timestamp_ns'], tf.float64) / 10**9, tf.float32)
+    return features, labels
+
+def timestamp_deltas(timestamp_ns) -> np.ndarray:
+    """
+    Decode the numeric timestamps of a single repetition to the seconds since the previous reading.
+    """
+    return np.diff(decode_timestamps(timestamp_ns), prepend=0.)
 
 
 # A utility method to create a feature column
@@ -32,19 +169,64 @@ def demo(feature_column, example_batch) -> None:
     print(feature_column.name)
     print(feature_layer(features).numpy())
 
+# Categorical columns are fed to the model as their index in the vocabulary
+VOCABULARIES = {
+    'subject_gender': ['m', 'f'],
+    'subject_handedness': ['l', 'r', 'a'],
+    'subject_impairment': [True, False],
+}
+
+# The dtypes numeric columns are fed to the model as
+DTYPES = export.DTYPES
+
+def to_feature_array(name, column: np.ndarray) -> np.ndarray:
+    """
+    Convert a column to the typed array it is fed to the model as.
+    """
+    if name in VOCABULARIES:
+        vocabulary = {value: code for code, value in enumerate(VOCABULARIES[name])}
+        uniques, inverse = np.unique(column, return_inverse=True)
+        try:
+            codes = np.array([vocabulary[value] for value in uniques.tolist()], dtype=np.int32)
+        except KeyError as error:
+            raise ValueError(f'{error} is not in the vocabulary of {name}')
+        return codes[inverse]
+    column, _ = export.column_values(np.asarray(column))
+    if name in DTYPES:
+        column = column.astype(DTYPES[name], copy=False)
+    return column
+
+def get_columns(columns, source=None) -> typing.Dict[str, np.ndarray]:
+    """
+    Fetch columns from the database, or from the export folder source, as typed arrays.
+    """
+    if source:
+        fetched = export.load_columns(source, columns)
+        return {name: to_feature_array(name, column) for name, column in fetched.items()}
+
+    # type every batch as it arrives, so only the narrowed arrays are held on to
+    typed: typing.Dict[str, list] = {name: [] for name in columns}
+    for batch in db.iter_all(TABLE, columnar=True, columns=columns):
+        for name in columns:
+            typed[name].append(to_feature_array(name, batch[name]))
+    if not typed[columns[0]]:
+        raise ValueError(f'{TABLE} holds no data')
+    return {name: np.concatenate(arrays) for name, arrays in typed.items()}
+
 feature_column_constructors = {
     'subject_id': lambda x=None: get_numeric_column('subject_id', tf.uint16, x), # TODO: Decide if this should be included
-    'subject_gender': lambda x=None: get_indicator_column('subject_gender', ['m', 'f'], x),
+    'subject_gender': lambda x=None: get_categorical_column_with_identity('subject_gender', len(VOCABULARIES['subject_gender']), x),
     'subject_age': lambda x=None: get_bucketized_column('subject_age', [18, 25, 30, 35, 40, 45, 50, 55, 60, 65], tf.uint8, x),
     'subject_fitness': lambda x=None: get_bucketized_column('subject_fitness', [2, 4, 6, 8], tf.uint8, x),
-    'subject_handedness': lambda x=None: get_indicator_column('subject_handedness', ['l', 'r', 'a'], x),
-    'subject_impairment': lambda x=None: get_indicator_column('subject_impairment', ['True', 'False'], x),
+    'subject_handedness': lambda x=None: get_categorical_column_with_identity('subject_handedness', len(VOCABULARIES['subject_handedness']), x),
+    'subject_impairment': lambda x=None: get_categorical_column_with_identity('subject_impairment', len(VOCABULARIES['subject_impairment']), x),
     'subject_wrist_circumference': lambda x=None: get_numeric_column('subject_wrist_circumference', tf.float32, x),
     'subject_forearm_circumference': lambda x=None: get_numeric_column('subject_forearm_circumference', tf.float32, x),
     'gesture': None, # TODO: Handle Label
     'repetition': None,
     'reading_count': lambda x=None: get_numeric_column('reading_count', tf.uint16, x),
     'timestamp': None, # TODO: Handle timestamps
+    'timestamp_ns': lambda x=None: get_numeric_column('timestamp_ns', tf.float32, x), # seconds, see decode_features
     'readings': lambda x=None: get_numeric_array_column('readings', 15, tf.uint8, x), 
     'arm_calibration_gesture': None, # TODO: Decide if this should be included
     'arm_calibration_iterations': lambda x=None: get_numeric_column('arm_calibration_iterations', tf.uint16, x),
@@ -62,8 +244,8 @@ def get_feature_columns(example_batch) -> List['feature_column']:
             columns.append(constructor(example_batch))
     return columns
 
-def get_categorical_column_with_identity(name, example_batch=None):
-    column = feature_column.categorical_column_with_identity(name, 2)
+def get_categorical_column_with_identity(name, num_buckets=2, example_batch=None):
+    column = feature_column.categorical_column_with_identity(name, num_buckets)
     column_one_hot = feature_column.indicator_column(column)
     if example_batch:
         demo(column_one_hot, example_batch) 
@@ -95,6 +277,7 @@ def get_indicator_column(name, vocabulary, example_batch=None) -> feature_column
         demo(column_one_hot, example_batch) 
     return column_one_hot
 
+TABLE = 'training_dataset'
 LABEL = 'gesture'
 FEATURES = [
         'subject_id',
@@ -109,6 +292,7 @@ FEATURES = [
         #'repetition',
         'reading_count',
         #'timestamp',
+        #'timestamp_ns',
         'readings',
         #'wrist_calibration_gesture',
         'wrist_calibration_iterations',
@@ -117,57 +301,58 @@ FEATURES = [
         'arm_calibration_iterations',
         'arm_calibration_values',
 ]
-def get_data(features=FEATURES, label=LABEL) -> Tuple[tf.data.Dataset]: 
+def get_data(features=FEATURES, label=LABEL, source=None, test_fraction=.2, split_by='subject', seed=0) -> Tuple[Split, Split]: 
     """
-    Retreives data from database.
-    Returns (train, test) tf.data.Datasets.
+    Retreives data from database, or from the export folder source written by export.py.
+    Returns (train, test) Splits, to build input pipelines from with build_pipeline and decode_features.
+    Whole subjects, or whole repetitions with split_by='repetition', are held out for testing, see splits.holdout.
     """
-    data = db.get_all('training', True)
+    grouping = ['subject_id', 'repetition']
+    columns = get_columns(list(dict.fromkeys([*features, *grouping, label])), source)
+    print(len(columns[label]))
 
-    print(len(data))
-    if len(data) > 5:
-        print(data[0])
-    else: 
-        print(data)
+    data_batched = {k:columns[k] for k in features}
+    labels = {'label':columns[label]}
 
-    data_batched = {k:[d[k] for d in data] for k in data[0] if k in features}
-    labels = {'label':[d[k] for d in data] for k in data[0] if k == label}
+    data = Split(data_batched, labels)
 
-    # Convert timestamps to iso format
-    if 'timestamp' in data_batched.keys():
-        print(data_batched['timestamp'][:5])
-        data_batched['timestamp'] = list(map(lambda x: x.isoformat(), data_batched['timestamp']))
-        print(data_batched['timestamp'][:5])
+    print('Filtering:')
+    mask = splits.holdout(columns, test_fraction, split_by, seed)
+    train = data.take(~mask)
+    test = data.take(mask)
 
-    # Convert boolean values to strings
-    if 'subject_impairment' in data_batched:
-        print(data_batched['subject_impairment'][:5])
-        data_batched['subject_impairment'] = list(map(str, data_batched['subject_impairment']))
-        print(data_batched['subject_impairment'][:5])
+    print(f'{train.count}/{test.count}')
 
+    return train, test
 
-    tf_data = tf.data.Dataset.from_tensor_slices((data_batched, labels))
-    print(len(list(tf_data)))
-    #print(list(tf_data))
 
-    print('Filtering:')
-    train = tf_data.filter(is_training)
-    test = tf_data.filter(is_test)
 
-    print(f'{len(list(train))}/{len(list(test))}')
+def get_windows(size=100, stride=50, features=FEATURES, label=LABEL, source=None) -> Windows:
+    """
+    Retreives data like get_data, as windows of size consecutive readings of a repetition
+    stride readings apart, for sequence models. Build the input pipeline with build_window_pipeline.
+    """
+    grouping = ['subject_id', 'repetition', 'reading_count']
+    columns = get_columns(list(dict.fromkeys([*features, *grouping, label])), source)
 
-    return train, test
+    data = Split({k:columns[k] for k in columns if k != label}, {'label':columns[label]})
+    windows = make_windows(data, size, stride)
+    print(f'{windows.count} windows of {size} readings')
+    return windows
 
 
 
-def run_model(train, test) -> None:
+def run_model(train: Split, test: Split, measure=False) -> None:
     batch_size = 5 # A small batch sized is used for demonstration purposes
-    train = train.shuffle(buffer_size=len(list(train))).batch(batch_size)
-
-    test = test.shuffle(buffer_size=len(list(test)))
     test, val = split(test, 5)
-    test = test.batch(batch_size)
-    val = val.batch(batch_size)
+
+    train_count = train.count
+    train = build_pipeline(train, batch_size, map_func=decode_features)
+    test = build_pipeline(test, batch_size, shuffle=False, map_func=decode_features)
+    val = build_pipeline(val, batch_size, shuffle=False, map_func=decode_features)
+    if measure:
+        # Costs an extra epoch, which fills the cache for the ones that follow
+        measure_throughput(train, train_count)
 
 
     # We will use this batch to demonstrate feature columns
@@ -210,10 +395,12 @@ def run_model(train, test) -> None:
     print(result)
     print('Model Evaluated.')
 
-def main():
-    train, test = get_data()
-    run_model(train, test)
+def main(source=None, measure=False):
+    train, test = get_data(source=source)
+    run_model(train, test, measure)
 
 
 if __name__ == "__main__":
-    main()
+    import sys
+    args = [arg for arg in sys.argv[1:] if arg != '--measure']
+    main(args[0] if args else None, '--measure' in sys.argv[1:])